@@ -0,0 +1,260 @@
+import logging
+import asyncio
+import os
+import time
+from typing import Iterable, Optional
+from dotenv import load_dotenv
+from telethon import errors
+from dbpool import acquire
+from userdb import iter_user_ids
+from flood_control import raise_flood_waits
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Telegram allows bots roughly 30 messages/second across all chats
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', '5'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))
+PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+MAX_FLOOD_RETRIES = 3
+
+# Recipients that can never succeed; retrying them only wastes rate budget
+PERMANENT_ERRORS = (
+    errors.UserIsBlockedError,
+    errors.InputUserDeactivatedError,
+    errors.PeerIdInvalidError,
+    errors.ChatWriteForbiddenError,
+)
+
+class TokenBucket:
+    """Async token bucket; block() stalls every sender for a FloodWait period"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Telegram's limit is per bot, so every job, resumed or new, draws from the same budget
+send_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+
+async def init_broadcast_db():
+    try:
+        async with acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id SERIAL PRIMARY KEY,
+                    admin_chat_id BIGINT NOT NULL,
+                    progress_message_id BIGINT,
+                    text TEXT,
+                    source_chat_id BIGINT,
+                    source_message_id BIGINT,
+                    caption TEXT,
+                    cursor BIGINT NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    skipped INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        logger.info("Broadcast database initialized successfully")
+    except Exception as e:
+        logger.error(f"Error initializing broadcast database: {e}")
+        raise
+
+async def create_broadcast_job(admin_chat_id: int, progress_message_id: int, text: str = None,
+                               source_chat_id: int = None, source_message_id: int = None,
+                               caption: str = None) -> int:
+    """Persist a new broadcast; media is referenced by its source message, not copied"""
+    async with acquire() as conn:
+        return await conn.fetchval('''
+            INSERT INTO broadcast_jobs
+            (admin_chat_id, progress_message_id, text, source_chat_id, source_message_id, caption)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING id
+        ''', admin_chat_id, progress_message_id, text, source_chat_id, source_message_id, caption)
+
+async def set_broadcast_status(job_id: int, status: str):
+    async with acquire() as conn:
+        await conn.execute('''
+            UPDATE broadcast_jobs SET status = $2, updated_at = CURRENT_TIMESTAMP WHERE id = $1
+        ''', job_id, status)
+
+async def get_running_jobs() -> list:
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+    return [dict(row) for row in rows]
+
+class Broadcast:
+    """Sends one broadcast job with bounded concurrency, resuming from its cursor"""
+
+    def __init__(self, client, job: dict, skip_user_ids: Iterable[int] = ()):
+        self.client = client
+        self.job = job
+        self.skip_user_ids = set(skip_user_ids)
+        self.bucket = send_bucket
+        self.sent = job['sent']
+        self.failed = job['failed']
+        self.skipped = job['skipped']
+        self.flood_waits = 0
+        self._media = None
+        self._last_progress = 0.0
+
+    async def _load_media(self):
+        if self.job['source_message_id'] is None:
+            return
+        message = await self.client.get_messages(self.job['source_chat_id'], ids=self.job['source_message_id'])
+        if message is None or not message.media:
+            raise RuntimeError("Broadcast source message is no longer available")
+        self._media = message.media
+
+    async def _deliver(self, user_id: int):
+        if self._media is not None:
+            await self.client.send_file(user_id, file=self._media, caption=self.job['caption'])
+        else:
+            await self.client.send_message(user_id, self.job['text'])
+
+    async def _send(self, user_id: int):
+        for _ in range(MAX_FLOOD_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self._deliver(user_id)
+                self.sent += 1
+                return
+            except errors.FloodWaitError as e:
+                # Telegram tells us exactly how long to back off; honour it for every sender
+                self.flood_waits += 1
+                logger.warning(f"FloodWait of {e.seconds}s during broadcast {self.job['id']}")
+                self.bucket.block(e.seconds)
+            except PERMANENT_ERRORS as e:
+                logger.info(f"Skipping unreachable user {user_id}: {e}")
+                break
+            except Exception as e:
+                logger.error(f"Failed to send to user {user_id}: {e}")
+                break
+        self.failed += 1
+
+    async def _save(self, cursor: int, status: str = 'running'):
+        async with acquire() as conn:
+            await conn.execute('''
+                UPDATE broadcast_jobs
+                SET cursor = $2, sent = $3, failed = $4, skipped = $5,
+                    status = $6, updated_at = CURRENT_TIMESTAMP
+                WHERE id = $1
+            ''', self.job['id'], cursor, self.sent, self.failed, self.skipped, status)
+
+    async def _edit_progress(self, text: str):
+        if not self.job['progress_message_id']:
+            return
+        try:
+            await self.client.edit_message(self.job['admin_chat_id'], self.job['progress_message_id'], text)
+        except errors.MessageNotModifiedError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not update broadcast progress: {e}")
+
+    async def _maybe_report_progress(self):
+        now = time.monotonic()
+        if now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        await self._edit_progress(
+            f"🚀 Broadcasting...\n"
+            f"✅ Sent: {self.sent}\n"
+            f"❌ Failed: {self.failed}\n"
+            f"⏩ Skipped (admins): {self.skipped}"
+        )
+
+    async def run(self) -> Optional[str]:
+        """Run the job to completion and return the final report"""
+        await self._load_media()
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send_one(user_id):
+            # A FloodWait must reach the shared bucket, not be slept off inside one sender
+            with raise_flood_waits():
+                async with semaphore:
+                    await self._send(user_id)
+
+        cursor = self.job['cursor']
+        async for batch in iter_user_ids(cursor, BROADCAST_BATCH_SIZE):
+            targets = [user_id for user_id in batch if user_id not in self.skip_user_ids]
+            self.skipped += len(batch) - len(targets)
+            await asyncio.gather(*(send_one(user_id) for user_id in targets))
+            # Everything up to the batch's last id is done; a restart resumes after it
+            cursor = batch[-1]
+            await self._save(cursor)
+            await self._maybe_report_progress()
+
+        await self._save(cursor, 'done')
+        report = (
+            "📬 Broadcast Completed\n\n"
+            f"✅ Successfully sent: {self.sent}\n"
+            f"❌ Failed: {self.failed}\n"
+            f"⏩ Skipped (admins): {self.skipped}\n"
+            f"👥 Total reach: {self.sent + self.failed}\n"
+            f"📊 Success rate: {(self.sent/(self.sent+self.failed)*100 if self.sent+self.failed>0 else 0):.1f}%"
+        )
+        await self._edit_progress(report)
+        logger.info(f"Broadcast {self.job['id']} finished: {self.sent} sent, {self.failed} failed, "
+                    f"{self.flood_waits} flood waits")
+        return report
+
+_running = set()
+
+def start_broadcast(client, job: dict, skip_user_ids: Iterable[int] = ()) -> asyncio.Task:
+    """Run a broadcast in the background, keeping a reference until it finishes"""
+    async def runner():
+        broadcast = Broadcast(client, job, skip_user_ids)
+        try:
+            await broadcast.run()
+        except Exception as e:
+            logger.error(f"Broadcast {job['id']} stopped: {e}")
+            # Otherwise it stays 'running' and is retried, and fails again, on every restart
+            try:
+                await set_broadcast_status(job['id'], 'failed')
+            except Exception as save_error:
+                logger.error(f"Could not mark broadcast {job['id']} as failed: {save_error}")
+            await broadcast._edit_progress(f"❌ Broadcast stopped: {e}")
+
+    task = asyncio.create_task(runner())
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
+
+async def resume_broadcasts(client, skip_user_ids: Iterable[int] = ()) -> int:
+    """Restart jobs that were interrupted mid-send, e.g. by a redeploy"""
+    jobs = await get_running_jobs()
+    for job in jobs:
+        logger.info(f"Resuming broadcast {job['id']} after user {job['cursor']}")
+        start_broadcast(client, job, skip_user_ids)
+    return len(jobs)
+
+async def get_broadcast_job(job_id: int) -> dict:
+    async with acquire() as conn:
+        row = await conn.fetchrow('SELECT * FROM broadcast_jobs WHERE id = $1', job_id)
+    return dict(row) if row else None
@@ -1,211 +1,714 @@
 import logging
+import asyncio
 import asyncpg
-import time
-import os
 from dotenv import load_dotenv
+import os
+import time
 import uuid
 import base64
-from typing import List, Tuple, Optional
+from typing import Callable, Dict, Iterable, List, Tuple, Optional, NamedTuple
+from dbpool import acquire
+from metrics import instrument_module
+from slow_queries import record_slow_query
+from cache import SingleFlight, TTLCache
+from search_query import STRATEGIES, build_tsquery, query_terms
+from memindex import memory_index, memory_search_enabled
+from invalidation import add_invalidation_handler, notify
+from bisect import bisect_left, bisect_right
 
 # Load environment variables from .env file
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-async def connect_to_db():
-    retries = 5
-    while retries > 0:
+# How search_page() reports totals: 'exact', 'capped' or 'estimate'
+SEARCH_COUNT_MODE = os.getenv('SEARCH_COUNT_MODE', 'capped')
+SEARCH_COUNT_CAP = int(os.getenv('SEARCH_COUNT_CAP', '1000'))
+
+# An AND query with fewer hits than this on its first page is retried as OR
+SEARCH_AND_MIN_RESULTS = int(os.getenv('SEARCH_AND_MIN_RESULTS', '5'))
+
+# Trigram fallback for misspellings, used only when full-text search finds too little
+FUZZY_MIN_RESULTS = int(os.getenv('FUZZY_MIN_RESULTS', '3'))
+FUZZY_THRESHOLD = float(os.getenv('FUZZY_THRESHOLD', '0.5'))
+fuzzy_search_available = False
+
+# Repeated searches are served from memory until the TTL lapses or a file is ingested
+search_cache = TTLCache(
+    maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '2000')),
+    ttl=float(os.getenv('SEARCH_CACHE_TTL', '300'))
+)
+# Identical searches arriving together share one database round trip
+search_flights = SingleFlight()
+# Bumped on every invalidation so a search that started earlier does not cache its stale page
+_search_generation = 0
+
+def invalidate_search_cache():
+    global _search_generation
+    _search_generation += 1
+    search_cache.clear()
+    search_flights.forget()
+
+# Callbacks told which file ids changed, so other modules can evict derived caches
+_file_change_listeners: List[Callable[[List[str]], None]] = []
+
+def add_file_change_listener(callback: Callable[[List[str]], None]):
+    _file_change_listeners.append(callback)
+
+def files_changed(file_ids: Iterable[str]):
+    file_ids = [str(file_id) for file_id in file_ids]
+    for callback in _file_change_listeners:
         try:
-            conn = await asyncpg.connect(
-                database=os.getenv('PGDATABASE'),
-                user=os.getenv('PGUSER'),
-                password=os.getenv('PGPASSWORD'),
-                host=os.getenv('PGHOST'),
-                port=os.getenv('PGPORT')
-            )
-            return conn
+            callback(file_ids)
         except Exception as e:
-            logger.error(f"Database connection failed: {e}")
-            retries -= 1
-            time.sleep(1)
-            if retries == 0:
-                logger.critical("Failed to connect to the database after multiple retries")
-                return None
-    return None
+            logger.error(f"File change listener failed: {e}")
+
+async def _remote_files_changed(file_ids: Optional[List[str]]):
+    """Apply file writes made by another process (e.g. the ingest command)"""
+    invalidate_search_cache()
+    if file_ids is None:
+        if memory_index.ready:
+            await memory_index.load()
+        return
+    if memory_index.tracking:
+        async with acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT id, caption, file_name, is_video FROM files WHERE id = ANY($1::text[])
+            ''', file_ids)
+        for row in rows:
+            memory_index.add_file(row['id'], row['caption'], row['file_name'], row['is_video'])
+    files_changed(file_ids)
+
+add_invalidation_handler('file', _remote_files_changed)
+
+VIDEO_EXTENSIONS = ['.mp4', '.mkv', '.webm', '.ts', '.mov', '.avi', '.flv', '.wmv', '.m4v', '.mpeg', '.mpg', '.3gp', '.3g2']
+
+# SQL twin of is_video_file(), used to backfill rows stored before is_video existed
+VIDEO_NAME_PATTERN = r'\.(' + '|'.join(ext.lstrip('.') for ext in VIDEO_EXTENSIONS) + r')$'
+
+def is_video_file(file_name: Optional[str], mime_type: Optional[str]) -> bool:
+    """Whether a document is playable video, judged by extension or MIME type"""
+    if file_name and file_name.lower().endswith(tuple(VIDEO_EXTENSIONS)):
+        return True
+    return bool(mime_type and mime_type.lower().startswith('video/'))
+
+class SearchCursor(NamedTuple):
+    """Keyset position in (rank DESC, id) order; backward pages towards the start"""
+    rank: float
+    id: str
+    backward: bool = False
+    strategy: str = 'and'
+
+class SearchPage(NamedTuple):
+    rows: List[asyncpg.Record]
+    total: int
+    total_is_exact: bool
+    has_next: bool = False
+    has_prev: bool = False
+    strategy: str = 'and'
+
+    def total_label(self) -> str:
+        return str(self.total) if self.total_is_exact else f"{self.total}+"
 
 async def init_db():
-    conn = await connect_to_db()
-    try:
-        # Create tables with proper constraints
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS files (
-                id TEXT PRIMARY KEY,
-                access_hash TEXT,
-                file_reference BYTEA,
-                mime_type TEXT,
-                caption TEXT,
-                keywords TEXT,
-                file_name TEXT
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS tokens (
-                token TEXT PRIMARY KEY,
-                file_id TEXT REFERENCES files(id),
-                UNIQUE(file_id)
-            )
-        ''')
-
-        # Create indexes
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_files_keywords 
-            ON files USING gin(to_tsvector('english', keywords))
-        ''')
-        
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_tokens_file_id 
-            ON tokens(file_id)
-        ''')
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-        raise
-    finally:
-        await conn.close()
+    global fuzzy_search_available
+    async with acquire() as conn:
+        try:
+            # Create tables with proper constraints
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    access_hash TEXT,
+                    file_reference BYTEA,
+                    mime_type TEXT,
+                    caption TEXT,
+                    keywords TEXT,
+                    file_name TEXT
+                )
+            ''')
+            
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS tokens (
+                    token TEXT PRIMARY KEY,
+                    file_id TEXT REFERENCES files(id),
+                    UNIQUE(file_id)
+                )
+            ''')
+
+            # Where each document was posted, so an expired file_reference can be re-fetched
+            await conn.execute('''
+                ALTER TABLE files
+                    ADD COLUMN IF NOT EXISTS source_chat_id BIGINT,
+                    ADD COLUMN IF NOT EXISTS source_message_id BIGINT,
+                    ADD COLUMN IF NOT EXISTS file_reference_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ''')
+
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_files_reference_age
+                ON files(file_reference_updated_at) WHERE source_message_id IS NOT NULL
+            ''')
+
+            # Last message id ingested per source chat, so bulk imports can resume
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS ingest_progress (
+                    source TEXT PRIMARY KEY,
+                    last_message_id BIGINT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Create indexes
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tokens_file_id 
+                ON tokens(file_id)
+            ''')
+
+            # Weighted full-text vector: file name (A) outranks caption (B)
+            await conn.execute('''
+                ALTER TABLE files ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+            ''')
+
+            await conn.execute('''
+                CREATE OR REPLACE FUNCTION files_search_vector(file_name TEXT, caption TEXT)
+                RETURNS TSVECTOR AS $$
+                    SELECT setweight(to_tsvector('english', regexp_replace(lower(coalesce(file_name, '')), '[._@()-]+', ' ', 'g')), 'A')
+                        || setweight(to_tsvector('english', regexp_replace(lower(coalesce(caption, '')), '[._@()-]+', ' ', 'g')), 'B')
+                $$ LANGUAGE sql IMMUTABLE
+            ''')
+
+            # Normalized title (no extension or separators) for typo-tolerant matching
+            await conn.execute('''
+                ALTER TABLE files ADD COLUMN IF NOT EXISTS title_norm TEXT
+            ''')
+
+            await conn.execute('''
+                CREATE OR REPLACE FUNCTION files_title_norm(file_name TEXT)
+                RETURNS TEXT AS $$
+                    SELECT btrim(regexp_replace(
+                        regexp_replace(lower(coalesce(file_name, '')), '\\.[a-z0-9]{2,4}$', ''),
+                        '[._@()-]+', ' ', 'g'))
+                $$ LANGUAGE sql IMMUTABLE
+            ''')
+
+            # Only re-tokenize when the indexed text actually changes
+            await conn.execute('''
+                CREATE OR REPLACE FUNCTION files_search_vector_update()
+                RETURNS TRIGGER AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT'
+                        OR NEW.search_vector IS NULL
+                        OR NEW.file_name IS DISTINCT FROM OLD.file_name
+                        OR NEW.caption IS DISTINCT FROM OLD.caption THEN
+                        NEW.search_vector := files_search_vector(NEW.file_name, NEW.caption);
+                    END IF;
+                    IF TG_OP = 'INSERT'
+                        OR NEW.title_norm IS NULL
+                        OR NEW.file_name IS DISTINCT FROM OLD.file_name THEN
+                        NEW.title_norm := files_title_norm(NEW.file_name);
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+
+            # Swapped atomically so writes from a running bot never slip in without the trigger
+            async with conn.transaction():
+                await conn.execute('DROP TRIGGER IF EXISTS trg_files_search_vector ON files')
+                await conn.execute('''
+                    CREATE TRIGGER trg_files_search_vector
+                    BEFORE INSERT OR UPDATE ON files
+                    FOR EACH ROW EXECUTE FUNCTION files_search_vector_update()
+                ''')
+
+            # Only playable videos are ever searched, so index just those
+            await conn.execute('''
+                ALTER TABLE files ADD COLUMN IF NOT EXISTS is_video BOOLEAN
+            ''')
+
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_files_video_search
+                ON files USING gin(search_vector) WHERE is_video
+            ''')
+
+            # pg_trgm may need a superuser to install; search works without it, minus the fuzzy fallback
+            try:
+                await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                await conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_files_title_trgm
+                    ON files USING gin(title_norm gin_trgm_ops) WHERE is_video
+                ''')
+                fuzzy_search_available = True
+            except asyncpg.PostgresError as e:
+                fuzzy_search_available = False
+                logger.warning(f"pg_trgm unavailable, fuzzy search disabled: {e}")
+
+            # Planner row estimate for an arbitrary query, used for cheap totals
+            await conn.execute('''
+                CREATE OR REPLACE FUNCTION estimate_row_count(query TEXT)
+                RETURNS BIGINT AS $$
+                DECLARE
+                    plan JSON;
+                BEGIN
+                    EXECUTE 'EXPLAIN (FORMAT JSON) ' || query INTO plan;
+                    RETURN (plan->0->'Plan'->>'Plan Rows')::BIGINT;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            raise
 
 async def store_file_metadata(id: str, access_hash: str, file_reference: bytes,
-                            mime_type: str, caption: str, keywords: str, file_name: str):
-    conn = await connect_to_db()
-    if not conn:
-        return None
-    try:
-        # Convert id and access_hash to strings if they're integers
-        id_str = str(id)
-        access_hash_str = str(access_hash)
-        
+                            mime_type: str, caption: str, keywords: str, file_name: str,
+                            source_chat_id: int = None, source_message_id: int = None):
+    # Convert id and access_hash to strings if they're integers
+    id_str = str(id)
+    access_hash_str = str(access_hash)
+
+    is_video = is_video_file(file_name, mime_type)
+
+    async with acquire() as conn:
         await conn.execute('''
             INSERT INTO files 
-            (id, access_hash, file_reference, mime_type, caption, keywords, file_name)
-            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            (id, access_hash, file_reference, mime_type, caption, keywords, file_name, is_video,
+             source_chat_id, source_message_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
             ON CONFLICT (id) DO UPDATE SET
                 access_hash = EXCLUDED.access_hash,
                 file_reference = EXCLUDED.file_reference,
                 mime_type = EXCLUDED.mime_type,
                 caption = EXCLUDED.caption,
                 keywords = EXCLUDED.keywords,
-                file_name = EXCLUDED.file_name
-        ''', id_str, access_hash_str, file_reference, mime_type, caption, keywords, file_name)
-    finally:
-        await conn.close()
+                file_name = EXCLUDED.file_name,
+                is_video = EXCLUDED.is_video,
+                source_chat_id = COALESCE(EXCLUDED.source_chat_id, files.source_chat_id),
+                source_message_id = COALESCE(EXCLUDED.source_message_id, files.source_message_id),
+                file_reference_updated_at = CURRENT_TIMESTAMP
+        ''', id_str, access_hash_str, file_reference, mime_type, caption, keywords, file_name, is_video,
+            source_chat_id, source_message_id)
+        await notify(conn, 'file', [id_str])
+
+    # A new or changed file can match any cached query
+    invalidate_search_cache()
+    if memory_index.tracking:
+        memory_index.add_file(id_str, caption, file_name, is_video)
+    files_changed([id_str])
+
+FILE_COLUMNS = ['id', 'access_hash', 'file_reference', 'mime_type', 'caption', 'keywords', 'file_name', 'is_video',
+                'source_chat_id', 'source_message_id']
+
+async def store_files_metadata(files: List[dict], progress: Optional[Tuple[str, int]] = None) -> int:
+    """Bulk upsert file metadata via COPY into a staging table and one merge.
 
-class AsyncPostgresConnection:
-    def __init__(self):
-        self.conn = None
+    Each dict carries the store_file_metadata() fields. progress, a
+    (source, last_message_id) pair, is saved in the same transaction so an
+    interrupted import resumes exactly after the last committed batch.
+    """
+    records = [
+        (str(f['id']), str(f['access_hash']), f['file_reference'], f['mime_type'], f['caption'],
+         f['keywords'], f['file_name'], is_video_file(f['file_name'], f['mime_type']),
+         f.get('source_chat_id'), f.get('source_message_id'))
+        for f in files
+    ]
+    columns = ', '.join(FILE_COLUMNS)
+    updates = ', '.join(
+        f"{column} = COALESCE(EXCLUDED.{column}, files.{column})" if column.startswith('source_')
+        else f"{column} = EXCLUDED.{column}"
+        for column in FILE_COLUMNS if column != 'id'
+    ) + ", file_reference_updated_at = CURRENT_TIMESTAMP"
 
-    async def __aenter__(self):
-        self.conn = await connect_to_db()
-        return self.conn
+    async with acquire() as conn:
+        async with conn.transaction():
+            if records:
+                await conn.execute(f'''
+                    CREATE TEMP TABLE files_staging
+                    ON COMMIT DROP
+                    AS SELECT {columns} FROM files WITH NO DATA
+                ''')
+                await conn.copy_records_to_table('files_staging', records=records, columns=FILE_COLUMNS)
+                # The same document can show up twice in one batch (e.g. reposts)
+                await conn.execute(f'''
+                    INSERT INTO files ({columns})
+                    SELECT DISTINCT ON (id) {columns} FROM files_staging ORDER BY id
+                    ON CONFLICT (id) DO UPDATE SET {updates}
+                ''')
+                await notify(conn, 'file', dict.fromkeys(record[0] for record in records))
+            if progress:
+                await conn.execute('''
+                    INSERT INTO ingest_progress (source, last_message_id)
+                    VALUES ($1, $2)
+                    ON CONFLICT (source) DO UPDATE SET
+                        last_message_id = GREATEST(ingest_progress.last_message_id, EXCLUDED.last_message_id),
+                        updated_at = CURRENT_TIMESTAMP
+                ''', *progress)
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.conn:
-            await self.conn.close()
+    if records:
+        invalidate_search_cache()
+        if memory_index.tracking:
+            for record in records:
+                memory_index.add_file(record[0], record[4], record[6], record[7])
+        files_changed(record[0] for record in records)
+    return len(records)
 
-async def get_connection():
-    return AsyncPostgresConnection()
+async def get_ingest_progress(source: str) -> int:
+    """Last message id already ingested from source, or 0"""
+    async with acquire() as conn:
+        last_id = await conn.fetchval('SELECT last_message_id FROM ingest_progress WHERE source = $1', source)
+    return last_id or 0
+
+async def backfill_search_columns(batch_size: int = 1000) -> int:
+    """Populate search_vector, title_norm and is_video for rows written before they existed.
+
+    Runs in short batches so ingestion and searches are never blocked for
+    long; drops the legacy expression index once every row is covered.
+    """
+    total = 0
+    while True:
+        async with acquire() as conn:
+            status = await conn.execute('''
+                UPDATE files
+                SET search_vector = coalesce(search_vector, files_search_vector(file_name, caption)),
+                    title_norm = coalesce(title_norm, files_title_norm(file_name)),
+                    is_video = coalesce(is_video,
+                        lower(coalesce(file_name, '')) ~ $2
+                        OR lower(coalesce(mime_type, '')) LIKE 'video/%')
+                WHERE id IN (
+                    SELECT id FROM files
+                    WHERE search_vector IS NULL OR is_video IS NULL OR title_norm IS NULL
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+            ''', batch_size, VIDEO_NAME_PATTERN)
+            updated = int(status.split()[-1])
+            # SKIP LOCKED shortens a batch whenever a writer holds some rows, so a short batch proves nothing
+            remaining = updated == batch_size or await conn.fetchval('''
+                SELECT EXISTS (
+                    SELECT 1 FROM files
+                    WHERE search_vector IS NULL OR is_video IS NULL OR title_norm IS NULL
+                    LIMIT 1
+                )
+            ''')
+        total += updated
+        if not remaining:
+            break
+        if updated < batch_size:
+            # Only locked rows are left; give their writers a moment to commit
+            await asyncio.sleep(1)
+        else:
+            logger.info(f"Backfilled search columns for {total} files so far")
+
+    async with acquire() as conn:
+        await conn.execute('DROP INDEX IF EXISTS idx_files_keywords')
+    if total:
+        logger.info(f"Search column backfill complete: {total} files updated")
+    return total
 
-# Update store_token function
 async def store_token(file_id: str) -> Optional[str]:
-    async with await get_connection() as conn:
-        if not conn:
-            return None
-            
-        try:
+    try:
+        async with acquire() as conn:
             # First try to get existing token
             result = await conn.fetchrow('SELECT token FROM tokens WHERE file_id = $1', file_id)
             if result:
                 return result['token']
 
             # If no existing token, create new one
-            token = str(uuid.uuid4())
-            encoded_token = base64.urlsafe_b64encode(token.encode()).decode()
+            encoded_token = new_token()
             
             result = await conn.fetchrow('''
                 INSERT INTO tokens (token, file_id)
                 VALUES ($1, $2)
                 RETURNING token
             ''', encoded_token, file_id)
-            
+            if result:
+                await notify(conn, 'token', [result['token']])
+
             return result['token'] if result else None
 
-        except asyncpg.PostgresError as e:
-            logger.error(f"Database error storing token: {e}")
-            return None
+    except asyncpg.PostgresError as e:
+        logger.error(f"Database error storing token: {e}")
+        return None
+
+def new_token() -> str:
+    return base64.urlsafe_b64encode(str(uuid.uuid4()).encode()).decode()
+
+async def store_tokens(file_ids: List[str]) -> Dict[str, str]:
+    """Return a token for every file id, creating missing ones in one statement"""
+    file_ids = list(dict.fromkeys(str(file_id) for file_id in file_ids))
+    if not file_ids:
+        return {}
+    try:
+        async with acquire() as conn:
+            # Both branches read the same snapshot, so each file id appears once
+            rows = await conn.fetch('''
+                WITH wanted AS (
+                    SELECT * FROM unnest($1::text[], $2::text[]) AS w(file_id, token)
+                ),
+                existing AS (
+                    SELECT t.file_id, t.token FROM tokens t JOIN wanted USING (file_id)
+                ),
+                inserted AS (
+                    INSERT INTO tokens (token, file_id)
+                    SELECT w.token, w.file_id FROM wanted w
+                    WHERE NOT EXISTS (SELECT 1 FROM existing e WHERE e.file_id = w.file_id)
+                    ON CONFLICT DO NOTHING
+                    RETURNING file_id, token
+                )
+                SELECT file_id, token, false AS created FROM existing
+                UNION ALL
+                SELECT file_id, token, true AS created FROM inserted
+            ''', file_ids, [new_token() for _ in file_ids])
+            created = [row['token'] for row in rows if row['created']]
+            if created:
+                await notify(conn, 'token', created)
+    except asyncpg.PostgresError as e:
+        logger.error(f"Database error storing tokens: {e}")
+        return {}
+
+    tokens = {row['file_id']: row['token'] for row in rows}
+    # Lost a race with a concurrent insert; fall back to the single-row path
+    for file_id in file_ids:
+        if file_id not in tokens:
+            token = await store_token(file_id)
+            if token:
+                tokens[file_id] = token
+    return tokens
 
-# Update get_file_by_token function
 async def get_file_by_token(token: str) -> Optional[str]:
-    async with await get_connection() as conn:
-        if not conn:
-            return None
+    async with acquire() as conn:
         record = await conn.fetchrow('SELECT file_id FROM tokens WHERE token = $1', token)
         return record['file_id'] if record else None
 
-# Update other functions to use the new connection manager
 async def get_file_by_id(file_id: str) -> Optional[Tuple]:
-    async with await get_connection() as conn:
-        if not conn:
-            return None
-        try:
+    try:
+        async with acquire() as conn:
             record = await conn.fetchrow('''
-                SELECT id, access_hash, file_reference, mime_type, caption, file_name 
+                SELECT id, access_hash, file_reference, mime_type, caption, file_name,
+                       source_chat_id, source_message_id
                 FROM files WHERE id = $1
             ''', file_id)
             return record
-        except asyncpg.PostgresError as e:
-            logger.error(f"Database error while fetching file: {e}")
-            return None
-
-# Modify search_files to use the GIN index
-async def search_files(keyword_list: List[str], page_size: int, offset: int):
-    conn = await connect_to_db()
-    if not conn:
+    except asyncpg.PostgresError as e:
+        logger.error(f"Database error while fetching file: {e}")
+        return None
+
+async def get_files_by_ids(file_ids: List[str]) -> List[asyncpg.Record]:
+    """get_file_by_id() for many files in one round trip; missing ids are skipped"""
+    async with acquire() as conn:
+        return await conn.fetch('''
+            SELECT id, access_hash, file_reference, mime_type, caption, file_name,
+                   source_chat_id, source_message_id
+            FROM files WHERE id = ANY($1::text[])
+        ''', [str(file_id) for file_id in file_ids])
+
+async def update_file_references(references: List[Tuple[str, Optional[str], Optional[bytes]]]):
+    """Persist the bot's (file_id, access_hash, file_reference) for re-fetched documents.
+
+    Both values are per-account, so they are always replaced together. A
+    None pair keeps the stored values but still marks the row as checked,
+    so unrecoverable files do not block the refresh queue.
+    """
+    if not references:
+        return
+    changed = [str(file_id) for file_id, _, file_reference in references if file_reference is not None]
+    async with acquire() as conn:
+        await conn.execute('''
+            UPDATE files
+            SET access_hash = COALESCE(r.access_hash, files.access_hash),
+                file_reference = COALESCE(r.file_reference, files.file_reference),
+                file_reference_updated_at = CURRENT_TIMESTAMP
+            FROM unnest($1::text[], $2::text[], $3::bytea[]) AS r(id, access_hash, file_reference)
+            WHERE files.id = r.id
+        ''', [str(file_id) for file_id, _, _ in references],
+            [None if access_hash is None else str(access_hash) for _, access_hash, _ in references],
+            [file_reference for _, _, file_reference in references])
+        await notify(conn, 'file', changed)
+    files_changed(changed)
+
+async def get_stale_file_references(max_age_hours: float, limit: int) -> List[asyncpg.Record]:
+    """Oldest file references past max_age_hours that can be re-fetched from their source"""
+    async with acquire() as conn:
+        return await conn.fetch('''
+            SELECT id, source_chat_id, source_message_id
+            FROM files
+            WHERE source_message_id IS NOT NULL
+              AND file_reference_updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            ORDER BY file_reference_updated_at
+            LIMIT $2
+        ''', max_age_hours * 3600, limit)
+
+async def fuzzy_search(text: str, limit: int) -> List[asyncpg.Record]:
+    """Typo-tolerant title match via the pg_trgm index, best matches first"""
+    if not fuzzy_search_available or not text:
         return []
     try:
-        tsquery = ' | '.join(f"'{kw}':*" for kw in keyword_list)
-        query = '''
-            SELECT id, caption, file_name 
-            FROM files 
-            WHERE to_tsvector('english', keywords) @@ to_tsquery('english', $1)
-            ORDER BY id
-            LIMIT $2 OFFSET $3
-        '''
-        return await conn.fetch(query, tsquery, page_size, offset)
+        async with acquire() as conn:
+            async with conn.transaction():
+                # Scoped to this transaction, so pooled connections keep the default
+                await conn.execute(
+                    "SELECT set_config('pg_trgm.word_similarity_threshold', $1, true)",
+                    str(FUZZY_THRESHOLD)
+                )
+                return await conn.fetch('''
+                    SELECT id, caption, file_name, word_similarity($1, title_norm)::real AS rank
+                    FROM files
+                    WHERE is_video AND $1 <% title_norm
+                    ORDER BY rank DESC, id
+                    LIMIT $2
+                ''', text, limit)
     except asyncpg.PostgresError as e:
-        logger.error(f"Database error in search: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error in search: {e}")
+        logger.error(f"Database error in fuzzy search: {e}")
         return []
-    finally:
-        await conn.close()
-
-# Modify count_search_results to use the GIN index
-async def count_search_results(keyword_list: List[str]) -> int:
-    conn = await connect_to_db()
-    if not conn:
-        return 0
+
+async def _fulltext_page(tsquery: str, page_size: int, cursor: Optional[SearchCursor],
+                         count_mode: str, strategy: str) -> Optional[SearchPage]:
+    """Run one full-text page query; None on database error"""
+    match = "is_video AND search_vector @@ to_tsquery('english', {})"
+    rank = "ts_rank_cd(search_vector, to_tsquery('english', $1))"
+
+    args = [tsquery, page_size + 1]
+
+    def param(value) -> str:
+        args.append(value)
+        return f"${len(args)}"
+
+    if cursor is None:
+        keyset, order = "", "rank DESC, id"
+    else:
+        cursor_rank, cursor_id = param(cursor.rank), param(cursor.id)
+        if cursor.backward:
+            keyset = f"AND ({rank} > {cursor_rank}::real OR ({rank} = {cursor_rank}::real AND id < {cursor_id}::text))"
+            order = "rank, id DESC"
+        else:
+            keyset = f"AND ({rank} < {cursor_rank}::real OR ({rank} = {cursor_rank}::real AND id > {cursor_id}::text))"
+            order = "rank DESC, id"
+
+    if count_mode == 'exact':
+        total_sql = f"SELECT COUNT(*) AS total FROM files WHERE {match.format('$1')}"
+    elif count_mode == 'estimate':
+        template = param(f"SELECT 1 FROM files WHERE {match.format('%L')}")
+        total_sql = f"SELECT estimate_row_count(format({template}::text, $1::text)) AS total"
+    else:
+        cap = param(SEARCH_COUNT_CAP + 1)
+        total_sql = f"SELECT COUNT(*) AS total FROM (SELECT 1 FROM files WHERE {match.format('$1')} LIMIT {cap}) capped"
+
+    # One extra row tells us whether another page exists in this direction
+    query = f'''
+        SELECT p.id, p.caption, p.file_name, p.rank, c.total
+        FROM ({total_sql}) c
+        LEFT JOIN LATERAL (
+            SELECT id, caption, file_name, {rank} AS rank
+            FROM files
+            WHERE {match.format('$1')} {keyset}
+            ORDER BY {order}
+            LIMIT $2
+        ) p ON true
+    '''
     try:
-        tsquery = ' | '.join(f"'{kw}':*" for kw in keyword_list)
-        query = '''
-            SELECT COUNT(*) 
-            FROM files 
-            WHERE to_tsvector('english', keywords) @@ to_tsquery('english', $1)
-        '''
-        return await conn.fetchval(query, tsquery)
+        async with acquire() as conn:
+            started = time.perf_counter()
+            records = await conn.fetch(query, *args)
+            elapsed = time.perf_counter() - started
     except asyncpg.PostgresError as e:
-        logger.error(f"Database error in count: {e}")
-        return 0
-    except Exception as e:
-        logger.error(f"Unexpected error in count: {e}")
-        return 0
-    finally:
-        await conn.close()
+        logger.error(f"Database error in search page: {e}")
+        return None
+
+    total = (records[0]['total'] or 0) if records else 0
+    rows = [r for r in records if r['id'] is not None]
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    record_slow_query('search_page', query, args, elapsed, len(rows), tsquery, strategy)
+    if cursor is not None and cursor.backward:
+        rows.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, cursor is not None
+
+    if count_mode == 'exact':
+        total_is_exact = True
+    elif count_mode == 'estimate':
+        # Never report fewer results than the user can actually see
+        total, total_is_exact = max(total, len(rows)), False
+    elif total > SEARCH_COUNT_CAP:
+        total, total_is_exact = SEARCH_COUNT_CAP, False
+    else:
+        total_is_exact = True
+    return SearchPage(rows, total, total_is_exact, has_next, has_prev, strategy)
+
+def _memory_page(keyword_list: List[str], page_size: int, cursor: Optional[SearchCursor],
+                 strategy: str) -> SearchPage:
+    """Serve a page from the in-memory index, keyset-paginated like the SQL path"""
+    keys = memory_index.search(keyword_list, strategy)
+    if cursor is None:
+        start, end = 0, min(page_size, len(keys))
+    elif cursor.backward:
+        end = bisect_left(keys, (-cursor.rank, cursor.id))
+        start = max(0, end - page_size)
+    else:
+        start = bisect_right(keys, (-cursor.rank, cursor.id))
+        end = min(start + page_size, len(keys))
+    rows = [dict(memory_index.row(id), rank=-neg_rank) for neg_rank, id in keys[start:end]]
+    return SearchPage(rows, len(keys), True, end < len(keys), start > 0, strategy)
+
+async def search_page(keyword_list: List[str], page_size: int,
+                      cursor: Optional[SearchCursor] = None,
+                      count_mode: Optional[str] = None) -> SearchPage:
+    """Fetch one page of matches and the total count in a single round trip.
+
+    The first page tries an AND of all terms, falls back to OR when that
+    finds fewer than SEARCH_AND_MIN_RESULTS, then to the trigram index; the
+    strategy used is reported on the page and carried by its cursors.
+    Pages are addressed by a keyset cursor on (rank, id), so every page costs
+    the same as the first. count_mode 'exact' counts every match, 'capped'
+    stops counting at SEARCH_COUNT_CAP and 'estimate' uses the planner's row
+    estimate.
+    """
+    count_mode = count_mode or SEARCH_COUNT_MODE
+    cache_key = (tuple(keyword_list), page_size, cursor, count_mode)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    if not query_terms(keyword_list):
+        return SearchPage([], 0, True)
+
+    # A trending title can arrive from dozens of users in the same second
+    return await search_flights.do(
+        cache_key, lambda: _search_uncached(keyword_list, page_size, cursor, count_mode, cache_key))
+
+async def _search_uncached(keyword_list: List[str], page_size: int, cursor: Optional[SearchCursor],
+                           count_mode: str, cache_key: tuple) -> SearchPage:
+    generation = _search_generation
+
+    if cursor is not None:
+        strategies = [cursor.strategy if cursor.strategy in STRATEGIES else 'or']
+    elif len(query_terms(keyword_list)) > 1:
+        strategies = list(STRATEGIES)
+    else:
+        strategies = ['and']  # A single term means the same thing either way
+
+    page = None
+    for strategy in strategies:
+        if memory_search_enabled():
+            page = _memory_page(keyword_list, page_size, cursor, strategy)
+        else:
+            page = await _fulltext_page(build_tsquery(keyword_list, strategy), page_size, cursor, count_mode, strategy)
+        if page is None:
+            return SearchPage([], 0, True)
+        if cursor is not None or len(page.rows) >= SEARCH_AND_MIN_RESULTS:
+            break
+
+    rows = page.rows
+    if cursor is None and len(rows) < FUZZY_MIN_RESULTS:
+        # Too few exact hits, likely a misspelling: top up from the trigram index
+        seen = {row['id'] for row in rows}
+        extra = [row for row in await fuzzy_search(' '.join(keyword_list), page_size) if row['id'] not in seen]
+        if extra:
+            rows = rows + extra[:page_size - len(rows)]
+            page = SearchPage(rows, len(rows), True, strategy='fuzzy')
+
+    logger.debug(f"Search for {keyword_list} used strategy '{page.strategy}'")
+    if generation == _search_generation:
+        search_cache.set(cache_key, page)
+    return page
+
+instrument_module(globals())
@@ -0,0 +1,80 @@
+import logging
+import asyncio
+import asyncpg
+import os
+from dotenv import load_dotenv
+from typing import Optional
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Pool tuning, overridable from the environment
+POOL_MIN_SIZE = int(os.getenv('PG_POOL_MIN_SIZE', '2'))
+POOL_MAX_SIZE = int(os.getenv('PG_POOL_MAX_SIZE', '10'))
+STATEMENT_CACHE_SIZE = int(os.getenv('PG_STATEMENT_CACHE_SIZE', '100'))
+ACQUIRE_TIMEOUT = float(os.getenv('PG_ACQUIRE_TIMEOUT', '10'))
+COMMAND_TIMEOUT = float(os.getenv('PG_COMMAND_TIMEOUT', '30'))
+MAX_INACTIVE_LIFETIME = float(os.getenv('PG_MAX_INACTIVE_LIFETIME', '300'))
+
+_pool: Optional[asyncpg.Pool] = None
+
+def connection_kwargs() -> dict:
+    """Connection parameters shared by the pool and dedicated connections"""
+    return dict(
+        database=os.getenv('PGDATABASE'),
+        user=os.getenv('PGUSER'),
+        password=os.getenv('PGPASSWORD'),
+        host=os.getenv('PGHOST'),
+        port=os.getenv('PGPORT')
+    )
+
+async def init_pool() -> asyncpg.Pool:
+    """Create the process-wide connection pool (idempotent)"""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    retries = 5
+    while True:
+        try:
+            _pool = await asyncpg.create_pool(
+                **connection_kwargs(),
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                statement_cache_size=STATEMENT_CACHE_SIZE,
+                command_timeout=COMMAND_TIMEOUT,
+                max_inactive_connection_lifetime=MAX_INACTIVE_LIFETIME
+            )
+            logger.info(f"Database pool created (min={POOL_MIN_SIZE}, max={POOL_MAX_SIZE})")
+            return _pool
+        except Exception as e:
+            logger.error(f"Database pool creation failed: {e}")
+            retries -= 1
+            if retries == 0:
+                logger.critical("Failed to connect to the database after multiple retries")
+                raise
+            await asyncio.sleep(1)
+
+async def close_pool():
+    """Gracefully close the pool, waiting for in-flight queries to finish"""
+    global _pool
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    try:
+        await asyncio.wait_for(pool.close(), timeout=ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Timed out closing database pool, terminating connections")
+        pool.terminate()
+    logger.info("Database pool closed")
+
+def get_pool() -> asyncpg.Pool:
+    if _pool is None:
+        raise RuntimeError("Database pool is not initialized; call init_pool() first")
+    return _pool
+
+def acquire():
+    """Acquire a pooled connection: `async with acquire() as conn: ...`"""
+    return get_pool().acquire(timeout=ACQUIRE_TIMEOUT)
@@ -0,0 +1,90 @@
+import logging
+import asyncio
+import os
+from collections import defaultdict
+from dotenv import load_dotenv
+from telethon import errors
+from database import update_file_references, get_stale_file_references
+from tasks import background_tasks
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Telegram does not publish a lifetime; references are refreshed well before they tend to lapse
+FILE_REFERENCE_MAX_AGE_HOURS = float(os.getenv('FILE_REFERENCE_MAX_AGE_HOURS', '12'))
+FILE_REFERENCE_REFRESH_INTERVAL = float(os.getenv('FILE_REFERENCE_REFRESH_INTERVAL', '3600'))
+FILE_REFERENCE_REFRESH_BATCH = int(os.getenv('FILE_REFERENCE_REFRESH_BATCH', '500'))
+GET_MESSAGES_CHUNK = 100  # messages.getMessages accepts at most ~100 ids per call
+
+# Errors that mean the stored document is not usable by the bot: an expired reference,
+# or an access_hash/file_reference issued to another account (e.g. an older user-session import)
+REFERENCE_ERRORS = (errors.FileReferenceExpiredError, errors.FileReferenceInvalidError, errors.MediaEmptyError)
+
+def _source_document(message, file_id):
+    document = getattr(message, 'document', None) if message else None
+    if document is None or str(document.id) != str(file_id):
+        return None
+    return document
+
+def _reference_row(file_id, document) -> tuple:
+    if document is None:
+        return (file_id, None, None)
+    return (file_id, str(document.access_hash), document.file_reference)
+
+async def refresh_document(client, file_info, background: bool = False):
+    """Re-fetch a file's source message as the bot and persist its access_hash and file_reference.
+
+    Returns the fresh Document, ready to send. With background=True the
+    database write is handed to the task queue so a waiting send can retry
+    as soon as Telegram answers.
+    """
+    if not file_info['source_message_id']:
+        return None
+    message = await client.get_messages(file_info['source_chat_id'], ids=file_info['source_message_id'])
+    document = _source_document(message, file_info['id'])
+    if document is None:
+        logger.warning(f"Source message for file {file_info['id']} no longer holds the document")
+        return None
+    references = [_reference_row(file_info['id'], document)]
+    if not (background and background_tasks.submit('persist file reference', update_file_references, references)):
+        await update_file_references(references)
+    logger.info(f"Refreshed file_reference for file {file_info['id']}")
+    return document
+
+async def refresh_stale_references(client) -> int:
+    """Refresh one batch of the oldest references, grouped by source chat"""
+    stale = await get_stale_file_references(FILE_REFERENCE_MAX_AGE_HOURS, FILE_REFERENCE_REFRESH_BATCH)
+    by_chat = defaultdict(list)
+    for row in stale:
+        by_chat[row['source_chat_id']].append(row)
+
+    refreshed = []
+    for chat_id, rows in by_chat.items():
+        for start in range(0, len(rows), GET_MESSAGES_CHUNK):
+            chunk = rows[start:start + GET_MESSAGES_CHUNK]
+            try:
+                messages = await client.get_messages(chat_id, ids=[row['source_message_id'] for row in chunk])
+            except errors.FloodWaitError as e:
+                logger.warning(f"FloodWait of {e.seconds}s while refreshing file references")
+                await asyncio.sleep(e.seconds)
+                continue
+            except Exception as e:
+                logger.error(f"Could not fetch source messages from chat {chat_id}: {e}")
+                continue
+            for row, message in zip(chunk, messages):
+                refreshed.append(_reference_row(row['id'], _source_document(message, row['id'])))
+
+    await update_file_references(refreshed)
+    count = sum(1 for _, _, file_reference in refreshed if file_reference is not None)
+    if stale:
+        logger.info(f"Refreshed {count} of {len(stale)} stale file references")
+    return count
+
+async def run_reference_refresher(client):
+    """Background loop that keeps stored file references from going stale"""
+    while True:
+        try:
+            await refresh_stale_references(client)
+        except Exception as e:
+            logger.error(f"Error refreshing file references: {e}")
+        await asyncio.sleep(FILE_REFERENCE_REFRESH_INTERVAL)
@@ -0,0 +1,52 @@
+import logging
+import asyncio
+import contextvars
+import os
+from contextlib import contextmanager
+from telethon import TelegramClient, errors
+from dotenv import load_dotenv
+from metrics import record_flood_wait
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# FloodWaits up to this many seconds are slept through and the request retried, as Telethon does by default
+FLOOD_SLEEP_THRESHOLD = float(os.getenv('FLOOD_SLEEP_THRESHOLD', '60'))
+
+# Per task, so a broadcast can take every FloodWait itself while handlers keep sleeping through short ones
+flood_sleep_limit: contextvars.ContextVar[float] = contextvars.ContextVar(
+    'flood_sleep_limit', default=FLOOD_SLEEP_THRESHOLD)
+
+@contextmanager
+def raise_flood_waits():
+    """Raise every FloodWaitError in this task (and tasks it starts) instead of sleeping it off"""
+    token = flood_sleep_limit.set(0)
+    try:
+        yield
+    finally:
+        flood_sleep_limit.reset(token)
+
+class FloodControlClient(TelegramClient):
+    """TelegramClient whose FloodWait auto-sleep threshold follows flood_sleep_limit.
+
+    Telethon sleeps inside the one request that hit the wait, using a
+    client-wide threshold. Here Telethon always raises and the sleep is
+    decided per task, so callers that pace themselves see every wait.
+    Every wait is counted here, for all requests the bot makes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['flood_sleep_threshold'] = 0
+        super().__init__(*args, **kwargs)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        threshold = flood_sleep_limit.get() if flood_sleep_threshold is None else flood_sleep_threshold
+        while True:
+            try:
+                return await super()._call(sender, request, ordered, 0)
+            except errors.FloodWaitError as e:
+                record_flood_wait(type(request).__name__, e.seconds)
+                if e.seconds > threshold:
+                    raise
+                logger.info(f"Sleeping {e.seconds}s for FloodWait on {type(request).__name__}")
+                await asyncio.sleep(e.seconds)
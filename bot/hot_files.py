@@ -0,0 +1,97 @@
+import logging
+import os
+from typing import List, NamedTuple, Optional
+from dotenv import load_dotenv
+from telethon.tl.types import Document, DocumentAttributeFilename
+from cache import TTLCache
+from database import get_file_by_id, get_files_by_ids, get_file_by_token, add_file_change_listener
+from invalidation import add_invalidation_handler
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+class HotFile(NamedTuple):
+    """A file ready to hand to client.send_file()"""
+    info: dict
+    document: Document
+    caption: str
+
+# Popular files are sent straight from memory; entries drop on re-ingest or reference refresh
+hot_files = TTLCache(
+    maxsize=int(os.getenv('HOT_FILE_CACHE_SIZE', '5000')),
+    ttl=float(os.getenv('HOT_FILE_CACHE_TTL', '3600'))
+)
+# Legacy table tokens never change their file, so token -> file id can live longer
+token_files = TTLCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', '20000')),
+    ttl=float(os.getenv('TOKEN_CACHE_TTL', '86400'))
+)
+
+def build_document(file_info):
+    """Rebuild a sendable Document from stored file metadata"""
+    return Document(
+        id=int(file_info['id']),
+        access_hash=int(file_info['access_hash']),
+        file_reference=bytes(file_info['file_reference']),  # Convert memoryview to bytes
+        date=None,
+        mime_type=file_info['mime_type'],
+        size=None,
+        dc_id=None,
+        attributes=[DocumentAttributeFilename(file_name=file_info['file_name'])]
+    )
+
+def make_hot_file(file_info) -> HotFile:
+    file_info = dict(file_info)
+    caption = file_info['file_name'].replace(" ", ".").replace("@", "")
+    return HotFile(file_info, build_document(file_info), caption)
+
+async def get_hot_file(file_id: str) -> Optional[HotFile]:
+    file_id = str(file_id)
+    hot = hot_files.get(file_id)
+    if hot is None:
+        file_info = await get_file_by_id(file_id)
+        if not file_info:
+            return None
+        hot = make_hot_file(file_info)
+        hot_files.set(file_id, hot)
+    return hot
+
+async def get_hot_files(file_ids: List[str]) -> List[HotFile]:
+    """Hot files in file_ids order, loading every cache miss in one query"""
+    file_ids = [str(file_id) for file_id in file_ids]
+    found = {file_id: hot_files.get(file_id) for file_id in file_ids}
+    missing = [file_id for file_id, hot in found.items() if hot is None]
+    if missing:
+        for file_info in await get_files_by_ids(missing):
+            hot = make_hot_file(file_info)
+            hot_files.set(hot.info['id'], hot)
+            found[hot.info['id']] = hot
+    return [found[file_id] for file_id in file_ids if found[file_id] is not None]
+
+async def get_file_id_by_token(token: str) -> Optional[str]:
+    file_id = token_files.get(token)
+    if file_id is None:
+        file_id = await get_file_by_token(token)
+        if file_id:
+            token_files.set(token, file_id)
+    return file_id
+
+def invalidate_files(file_ids: List[str]):
+    for file_id in file_ids:
+        hot_files.pop(file_id)
+
+def _remote_files_changed(file_ids: Optional[List[str]]):
+    # Specific ids already arrive through the database module's file change listeners
+    if file_ids is None:
+        hot_files.clear()
+
+def _remote_tokens_changed(tokens: Optional[List[str]]):
+    if tokens is None:
+        token_files.clear()
+        return
+    for token in tokens:
+        token_files.pop(token)
+
+add_file_change_listener(invalidate_files)
+add_invalidation_handler('file', _remote_files_changed)
+add_invalidation_handler('token', _remote_tokens_changed)
@@ -0,0 +1,71 @@
+import logging
+import asyncio
+import os
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from cache import TTLCache
+from database import SearchPage, search_page
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Telegram shows at most 50 inline results
+INLINE_RESULT_LIMIT = min(int(os.getenv('INLINE_RESULT_LIMIT', '20')), 50)
+INLINE_MIN_QUERY_LENGTH = int(os.getenv('INLINE_MIN_QUERY_LENGTH', '2'))
+# Seconds the user's client may reuse an answer before asking again
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '30'))
+# Keystrokes closer together than this only answer the last one
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE_MS', '150')) / 1000
+# A lookup slower than this answers empty and finishes in the background for the next keystroke
+INLINE_LATENCY_BUDGET = float(os.getenv('INLINE_LATENCY_BUDGET_MS', '80')) / 1000
+
+# Built InputBotInlineResult lists keyed on (normalized query, premium)
+inline_results = TTLCache(
+    maxsize=int(os.getenv('INLINE_CACHE_SIZE', '2000')),
+    ttl=INLINE_CACHE_TIME
+)
+
+inline_stats = {
+    "queries": 0,
+    "cache_hits": 0,
+    "debounced": 0,
+    "over_budget": 0,
+    "answered": 0,
+}
+
+class Debouncer:
+    """Lets only the latest of a user's rapid-fire queries through"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._seq = 0
+        self._latest: Dict[int, int] = {}
+
+    async def settle(self, user_id: int) -> bool:
+        """Wait out the debounce window; False if a newer query from user_id arrived"""
+        self._seq += 1
+        seq = self._latest[user_id] = self._seq
+        await asyncio.sleep(self.delay)
+        if self._latest.get(user_id) != seq:
+            inline_stats["debounced"] += 1
+            return False
+        del self._latest[user_id]
+        return True
+
+inline_debouncer = Debouncer(INLINE_DEBOUNCE)
+
+def _consume_result(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Background inline search failed: {task.exception()}")
+
+async def search_within_budget(keyword_list: List[str]) -> Optional[SearchPage]:
+    """First page of matches, or None if the lookup overran INLINE_LATENCY_BUDGET"""
+    # Inline results never show a total, so the cheapest count mode will do
+    task = asyncio.ensure_future(search_page(keyword_list, INLINE_RESULT_LIMIT, count_mode='estimate'))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), INLINE_LATENCY_BUDGET)
+    except asyncio.TimeoutError:
+        # Left running so search_page() caches it for the user's next keystroke
+        inline_stats["over_budget"] += 1
+        task.add_done_callback(_consume_result)
+        return None
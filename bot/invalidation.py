@@ -0,0 +1,115 @@
+import logging
+import asyncio
+import inspect
+import os
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional
+import asyncpg
+from dotenv import load_dotenv
+from dbpool import connection_kwargs
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'cache_invalidation'
+RECONNECT_DELAY = float(os.getenv('INVALIDATION_RECONNECT_DELAY', '5'))
+KEEPALIVE_INTERVAL = float(os.getenv('INVALIDATION_KEEPALIVE_INTERVAL', '30'))
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD_BYTES = 7900
+
+# Tags this process's notifications; its own writes were already applied locally
+ORIGIN = uuid.uuid4().hex[:12]
+
+# kind -> callbacks taking the changed keys, or None meaning "drop everything"
+_handlers: Dict[str, List[Callable[[Optional[List[str]]], None]]] = defaultdict(list)
+_pending = set()
+
+def add_invalidation_handler(kind: str, callback: Callable[[Optional[List[str]]], None]):
+    """Register a cache eviction callback; it may be a plain function or a coroutine function"""
+    _handlers[kind].append(callback)
+
+def _payloads(kind: str, keys: List[str]) -> Iterable[str]:
+    header = f"{ORIGIN} {kind}"
+    payload = header
+    for key in keys:
+        if len(payload) + len(key) + 1 > MAX_PAYLOAD_BYTES and payload != header:
+            yield payload
+            payload = header
+        payload += f" {key}"
+    if payload != header:
+        yield payload
+
+async def notify(conn, kind: str, keys: Iterable) -> None:
+    """Announce changed keys to every listening process.
+
+    Sent on the writer's connection, so inside a transaction the
+    notification is delivered only if and when it commits.
+    """
+    keys = [str(key) for key in keys]
+    for payload in _payloads(kind, keys):
+        await conn.execute('SELECT pg_notify($1, $2)', CHANNEL, payload)
+
+def _run_handler(kind: str, callback, keys: Optional[List[str]]):
+    try:
+        result = callback(keys)
+    except Exception as e:
+        logger.error(f"Invalidation handler for '{kind}' failed: {e}")
+        return
+    if inspect.isawaitable(result):
+        task = asyncio.ensure_future(result)
+        _pending.add(task)
+        task.add_done_callback(_handler_done(kind))
+
+def _handler_done(kind: str):
+    def done(task: asyncio.Task):
+        _pending.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Invalidation handler for '{kind}' failed: {task.exception()}")
+    return done
+
+def _on_notification(connection, pid, channel, payload):
+    origin, kind, *keys = payload.split(' ')
+    if origin == ORIGIN:
+        return
+    for callback in _handlers.get(kind, ()):
+        _run_handler(kind, callback, keys)
+
+def flush_all():
+    """Drop every registered cache, e.g. after notifications may have been missed"""
+    logger.info("Flushing all invalidation-managed caches")
+    for kind, callbacks in list(_handlers.items()):
+        for callback in callbacks:
+            _run_handler(kind, callback, None)
+
+async def run_invalidation_listener():
+    """Keep one LISTEN connection open for the life of the process"""
+    listened_before = False
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(**connection_kwargs())
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _: lost.set())
+            await conn.add_listener(CHANNEL, _on_notification)
+            # Anything written while we were not listening went unannounced
+            if listened_before:
+                flush_all()
+            listened_before = True
+            logger.info(f"Listening for cache invalidations on '{CHANNEL}'")
+
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Catches half-open connections that never report termination
+                    await conn.execute('SELECT 1', timeout=KEEPALIVE_INTERVAL)
+            logger.warning("Invalidation listener connection lost")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Invalidation listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        await asyncio.sleep(RECONNECT_DELAY)
@@ -0,0 +1,174 @@
+import logging
+import asyncio
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+from dbpool import acquire
+from search_query import MIN_PREFIX_LENGTH, query_terms, tokenize
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# 'memory' serves searches from this index; anything else keeps them in Postgres
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'postgres')
+
+class InvertedIndex:
+    """Compact in-process inverted index over playable files.
+
+    Tokens are interned to integer ids; each token owns an array('I') of
+    document numbers. Document numbers only ever grow, so appending keeps
+    every postings list sorted. A sorted token list answers prefix lookups
+    with two bisects. Re-ingested files get a new document number and the
+    old one is tombstoned.
+
+    load() builds a replacement off to the side and swaps it in, so a
+    reload never serves a half-built index.
+    """
+
+    def __init__(self):
+        self._token_ids: Dict[str, int] = {}
+        self._postings: List[array] = []
+        self._sorted_tokens: List[str] = []
+        self._rows: List[Optional[dict]] = []  # doc number -> row, None once tombstoned
+        self._doc_numbers: Dict[str, int] = {}  # file id -> live doc number
+        self.ready = False
+        self.load_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self._pending: Optional[List[tuple]] = None  # ingests seen while a load is running
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def tracking(self) -> bool:
+        """Whether ingests should be fed to add_file()"""
+        return self.ready or self._pending is not None
+
+    def __len__(self) -> int:
+        return len(self._doc_numbers)
+
+    def _add(self, id: str, caption: str, file_name: str, sort_tokens: bool = True):
+        doc = len(self._rows)
+        self._rows.append({'id': id, 'caption': caption, 'file_name': file_name})
+        self._doc_numbers[id] = doc
+
+        title = os.path.splitext(file_name or '')[0]
+        for token in set(tokenize(title) + tokenize(caption or '')):
+            token_id = self._token_ids.get(token)
+            if token_id is None:
+                token = sys.intern(token)
+                token_id = self._token_ids[token] = len(self._postings)
+                self._postings.append(array('I'))
+                if sort_tokens:
+                    insort(self._sorted_tokens, token)
+                else:
+                    self._sorted_tokens.append(token)
+            self._postings[token_id].append(doc)
+
+    def remove(self, id: str):
+        doc = self._doc_numbers.pop(str(id), None)
+        if doc is not None:
+            self._rows[doc] = None
+
+    def add_file(self, id: str, caption: str, file_name: str, is_video: bool = True):
+        """Apply one ingest; replaces any earlier version of the file"""
+        id = str(id)
+        if self._pending is not None:
+            # The snapshot being loaded may predate this write; replay it onto the new index
+            self._pending.append((id, caption, file_name, is_video))
+        if not self.ready:
+            return
+        self.remove(id)
+        if is_video:
+            self._add(id, caption, file_name)
+
+    async def load(self, batch_size: int = 5000):
+        """(Re)build the index from the files table, streaming rows with a server-side cursor"""
+        # Overlapping reloads (e.g. back-to-back listener reconnects) run one after the other
+        async with self._load_lock:
+            started = time.perf_counter()
+            fresh = InvertedIndex()
+            self._pending = []
+            try:
+                async with acquire() as conn:
+                    async with conn.transaction():
+                        async for row in conn.cursor(
+                                'SELECT id, caption, file_name FROM files WHERE is_video ORDER BY id',
+                                prefetch=batch_size):
+                            fresh._add(row['id'], row['caption'], row['file_name'], sort_tokens=False)
+                fresh._sorted_tokens.sort()
+                fresh.ready = True
+                for ingest in self._pending:
+                    fresh.add_file(*ingest)
+            finally:
+                self._pending = None
+
+            # No await from the replay to here, so no ingest can fall in between
+            for attr in ('_token_ids', '_postings', '_sorted_tokens', '_rows', '_doc_numbers'):
+                setattr(self, attr, getattr(fresh, attr))
+            self.load_seconds = time.perf_counter() - started
+            self.ready = True
+        logger.info(f"In-memory search index loaded: {len(self)} files, "
+                    f"{len(self._postings)} tokens in {self.load_seconds:.2f}s")
+
+    def _term_docs(self, term: str) -> Set[int]:
+        if len(term) < MIN_PREFIX_LENGTH:
+            token_id = self._token_ids.get(term)
+            return set(self._postings[token_id]) if token_id is not None else set()
+        lo = bisect_left(self._sorted_tokens, term)
+        hi = bisect_right(self._sorted_tokens, term + '\U0010ffff', lo)
+        docs = set()
+        for token in self._sorted_tokens[lo:hi]:
+            docs.update(self._postings[self._token_ids[token]])
+        return docs
+
+    def search(self, keyword_list: List[str], strategy: str = 'and') -> List[Tuple[float, str]]:
+        """Matches as (-rank, file id) keys, best first; rank is the number of terms hit"""
+        started = time.perf_counter()
+        term_docs = [self._term_docs(term) for term in query_terms(keyword_list)]
+        if not term_docs:
+            matches = Counter()
+        elif strategy == 'and':
+            docs = set.intersection(*term_docs)
+            matches = Counter({doc: len(term_docs) for doc in docs})
+        else:
+            matches = Counter()
+            for docs in term_docs:
+                matches.update(docs)
+
+        rows = self._rows
+        results = sorted((-float(score), rows[doc]['id']) for doc, score in matches.items() if rows[doc] is not None)
+        self.queries += 1
+        self.query_seconds += time.perf_counter() - started
+        return results
+
+    def row(self, id: str) -> dict:
+        return self._rows[self._doc_numbers[id]]
+
+    def memory_bytes(self) -> int:
+        """Approximate footprint of tokens, postings and stored rows"""
+        total = sum(sys.getsizeof(token) for token in self._token_ids)
+        total += sys.getsizeof(self._token_ids) + sys.getsizeof(self._sorted_tokens)
+        total += sum(postings.buffer_info()[1] * postings.itemsize + 64 for postings in self._postings)
+        for row in self._rows:
+            if row is not None:
+                total += sys.getsizeof(row) + sum(sys.getsizeof(value or '') for value in row.values())
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self),
+            "tokens": len(self._postings),
+            "load_seconds": self.load_seconds,
+            "memory_mb": self.memory_bytes() / (1024 * 1024),
+            "avg_query_us": (self.query_seconds / self.queries * 1e6) if self.queries else 0.0,
+        }
+
+memory_index = InvertedIndex()
+
+def memory_search_enabled() -> bool:
+    return SEARCH_BACKEND == 'memory' and memory_index.ready
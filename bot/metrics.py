@@ -0,0 +1,229 @@
+import logging
+import asyncio
+import functools
+import inspect
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# The bot serves /metrics here; the Django app proxies it for scrapers. Port 0 disables it.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Seconds; spans cache hits (sub-millisecond) to slow uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic count per label set"""
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+class CallbackCounter(Counter):
+    """Counter whose values are read from existing state at scrape time, costing nothing per event"""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], collect: Callable[[], Dict[LabelValues, float]]):
+        super().__init__(name, help, labels)
+        self._collect = collect
+
+    def samples(self) -> Iterable[str]:
+        self._values = self._collect()
+        return super().samples()
+
+class Histogram:
+    """Fixed-bucket histogram; Prometheus derives p50/p99 from the cumulative buckets"""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterable[str]:
+        bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def callback_counter(self, name: str, help: str, labels: Tuple[str, ...],
+                         collect: Callable[[], Dict[LabelValues, float]]) -> CallbackCounter:
+        return self._register(CallbackCounter(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format 0.0.4"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logger.error(f"Could not collect metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'bot_handler_duration_seconds', 'Time spent in a Telegram update handler', ('handler',))
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Update handlers that raised', ('handler',))
+db_call_seconds = registry.histogram(
+    'bot_db_call_duration_seconds', 'Time spent in a database module function', ('function',))
+db_call_errors = registry.counter(
+    'bot_db_call_errors_total', 'Database module functions that raised', ('function',))
+flood_waits = registry.counter(
+    'bot_flood_waits_total', 'FloodWait errors returned by Telegram', ('request',))
+flood_wait_seconds = registry.counter(
+    'bot_flood_wait_seconds_total', 'Seconds Telegram asked us to back off', ('request',))
+
+def record_flood_wait(request: str, seconds: float):
+    """Called by FloodControlClient for every FloodWait, whether it is slept off or raised"""
+    flood_waits.inc(request=request)
+    flood_wait_seconds.inc(seconds, request=request)
+
+async def time_handler(name: str, handler, *args):
+    """Run an update handler under the handler histogram"""
+    try:
+        with handler_seconds.time(handler=name):
+            return await handler(*args)
+    except Exception:
+        handler_errors.inc(handler=name)
+        raise
+
+def _timed(fn, name: str):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            with db_call_seconds.time(function=name):
+                return await fn(*args, **kwargs)
+        except Exception:
+            db_call_errors.inc(function=name)
+            raise
+    return wrapper
+
+def instrument_module(namespace: dict):
+    """Time every coroutine function defined in a module; call as instrument_module(globals()) at its end.
+
+    Rebinding the module globals means callers that import the functions
+    afterwards, and calls inside the module, all go through the timer.
+    """
+    module = namespace['__name__']
+    for attr, value in list(namespace.items()):
+        if inspect.iscoroutinefunction(value) and value.__module__ == module:
+            namespace[attr] = _timed(value, f"{module}.{attr}")
+
+def register_cache_metrics(caches: dict):
+    """Export hit/miss counts of TTLCache instances, read at scrape time"""
+    def collect():
+        values = {}
+        for name, cache in caches.items():
+            values[(name, 'hit')] = cache.hits
+            values[(name, 'miss')] = cache.misses
+        return values
+    registry.callback_counter('bot_cache_requests_total', 'Cache lookups by result', ('cache', 'result'), collect)
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass  # headers are not needed
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server() -> Optional[asyncio.AbstractServer]:
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(_serve, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logger.error(f"Could not start metrics server on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return None
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
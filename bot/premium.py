@@ -1,106 +1,125 @@
 import logging
-import asyncpg
+import asyncio
 from datetime import datetime, timedelta
-import os
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
+from dbpool import acquire
+from metrics import instrument_module
+from invalidation import add_invalidation_handler, notify
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Active premium users and their expiry, so is_premium() never touches the database
+_premium_expiry: Dict[int, datetime] = {}
+_expiry_timers: Dict[int, asyncio.TimerHandle] = {}
+
+def _expire_premium(user_id: int):
+    _premium_expiry.pop(user_id, None)
+    _expiry_timers.pop(user_id, None)
+    logger.info(f"Premium expired for user {user_id}")
+
+def _cache_premium(user_id: int, expiry_date: datetime):
+    """Record an expiry and schedule its eviction at expiry_date"""
+    timer = _expiry_timers.pop(user_id, None)
+    if timer:
+        timer.cancel()
+
+    remaining = (expiry_date - datetime.now()).total_seconds()
+    if remaining <= 0:
+        _premium_expiry.pop(user_id, None)
+        return
+
+    _premium_expiry[user_id] = expiry_date
+    _expiry_timers[user_id] = asyncio.get_running_loop().call_later(remaining, _expire_premium, user_id)
+
+async def load_premium_cache() -> int:
+    """Fill the premium cache from premium_users; call once at startup"""
+    async with acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT user_id, expiry_date FROM premium_users
+            WHERE expiry_date > CURRENT_TIMESTAMP
+        ''')
+    for row in rows:
+        _cache_premium(row['user_id'], row['expiry_date'])
+    logger.info(f"Loaded {len(_premium_expiry)} active premium users")
+    return len(_premium_expiry)
+
+async def _remote_premium_changed(user_ids: Optional[List[str]]):
+    """Re-read premium rows written by another process"""
+    if user_ids is None:
+        for timer in _expiry_timers.values():
+            timer.cancel()
+        _expiry_timers.clear()
+        _premium_expiry.clear()
+        await load_premium_cache()
+        return
+    user_ids = [int(user_id) for user_id in user_ids]
+    async with acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT user_id, expiry_date FROM premium_users WHERE user_id = ANY($1::bigint[])
+        ''', user_ids)
+    expiries = {row['user_id']: row['expiry_date'] for row in rows}
+    for user_id in user_ids:
+        if user_id in expiries:
+            _cache_premium(user_id, expiries[user_id])
+        else:
+            _premium_expiry.pop(user_id, None)
+            timer = _expiry_timers.pop(user_id, None)
+            if timer:
+                timer.cancel()
+
+add_invalidation_handler('premium', _remote_premium_changed)
+
+def premium_cache_size() -> int:
+    return len(_premium_expiry)
+
 async def init_premium_db():
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS premium_users (
-                user_id BIGINT PRIMARY KEY,
-                expiry_date TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        async with acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS premium_users (
+                    user_id BIGINT PRIMARY KEY,
+                    expiry_date TIMESTAMP NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
         logger.info("Premium database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing premium database: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 async def is_premium(user_id: int) -> bool:
-    conn = None
-    try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        result = await conn.fetchrow('''
-            SELECT * FROM premium_users 
-            WHERE user_id = $1 AND expiry_date > CURRENT_TIMESTAMP
-        ''', user_id)
-        
-        return bool(result)
-    except Exception as e:
-        logger.error(f"Error checking premium status: {e}")
-        return False
-    finally:
-        if conn:
-            await conn.close()
+    expiry_date = _premium_expiry.get(user_id)
+    return expiry_date is not None and expiry_date > datetime.now()
 
 async def add_or_renew_premium(user_id: int, days: int) -> bool:
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
         expiry_date = datetime.now() + timedelta(days=days)
         
-        await conn.execute('''
-            INSERT INTO premium_users (user_id, expiry_date)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE
-            SET expiry_date = $2
-        ''', user_id, expiry_date)
+        async with acquire() as conn:
+            await conn.execute('''
+                INSERT INTO premium_users (user_id, expiry_date)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE
+                SET expiry_date = $2
+            ''', user_id, expiry_date)
+            await notify(conn, 'premium', [user_id])
         
+        _cache_premium(user_id, expiry_date)
         return True
     except Exception as e:
         logger.error(f"Error adding/renewing premium: {e}")
         return False
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_premium_status(user_id: int) -> dict:
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        result = await conn.fetchrow('''
-            SELECT * FROM premium_users 
-            WHERE user_id = $1
-        ''', user_id)
+        async with acquire() as conn:
+            result = await conn.fetchrow('''
+                SELECT * FROM premium_users 
+                WHERE user_id = $1
+            ''', user_id)
         
         if result:
             expiry_date = result['expiry_date']
@@ -121,6 +140,5 @@ async def get_premium_status(user_id: int) -> dict:
     except Exception as e:
         logger.error(f"Error getting premium status: {e}")
         return None
-    finally:
-        if conn:
-            await conn.close()
+
+instrument_module(globals())
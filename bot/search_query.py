@@ -0,0 +1,44 @@
+import os
+import re
+from typing import List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Prefix-matching a token shorter than this expands to a huge slice of the index
+# ('2':* hits every year), so short tokens only ever match whole lexemes
+MIN_PREFIX_LENGTH = int(os.getenv('SEARCH_MIN_PREFIX_LENGTH', '3'))
+
+# Strategies in the order search_page() tries them; also encoded into page cursors
+STRATEGIES = ('and', 'or')
+
+# Anything that is not a word character would be tsquery syntax (quotes, &, |, !, :)
+_UNSAFE = re.compile(r'[^\w]+')
+
+def query_terms(keyword_list: List[str]) -> List[str]:
+    """Sanitize keywords and drop single characters unless nothing else is left"""
+    tokens = []
+    for keyword in keyword_list:
+        tokens.extend(token for token in _UNSAFE.split(keyword.lower()) if token)
+    tokens = list(dict.fromkeys(tokens))
+    meaningful = [token for token in tokens if len(token) > 1]
+    return meaningful or tokens
+
+def build_tsquery(keyword_list: List[str], strategy: str = 'and') -> str:
+    """Build a to_tsquery() string joining terms with AND or OR.
+
+    Long tokens become prefix matches so partial titles still hit; short
+    ones are matched exactly. Stopwords are removed by the 'english' config.
+    """
+    operator = ' & ' if strategy == 'and' else ' | '
+    return operator.join(
+        f"'{term}':*" if len(term) >= MIN_PREFIX_LENGTH else f"'{term}'"
+        for term in query_terms(keyword_list)
+    )
+
+# Titles also use '_' as a separator, which \w would keep inside tokens
+_SEPARATORS = re.compile(r'[\W_]+')
+
+def tokenize(text: str) -> List[str]:
+    """Split stored file names and captions into index tokens"""
+    return [token for token in _SEPARATORS.split(text.lower()) if token]
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+from typing import Optional
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Signed tokens are only issued when a secret is configured; legacy table tokens still work
+TOKEN_SECRET = os.getenv('DOWNLOAD_TOKEN_SECRET', '')
+TOKEN_TTL = int(os.getenv('DOWNLOAD_TOKEN_TTL', '0'))  # seconds, 0 = never expires
+
+PREFIX = 's1'
+_PAYLOAD = struct.Struct('>qI')  # file id, expiry (unix seconds, 0 = none)
+_MAC_SIZE = 12
+TOKEN_LENGTH = len(PREFIX) + len(base64.urlsafe_b64encode(b'\0' * (_PAYLOAD.size + _MAC_SIZE)))
+
+def signed_tokens_enabled() -> bool:
+    return bool(TOKEN_SECRET)
+
+def _mac(payload: bytes) -> bytes:
+    return hmac.new(TOKEN_SECRET.encode(), PREFIX.encode() + payload, hashlib.sha256).digest()[:_MAC_SIZE]
+
+def is_signed_token(token: str) -> bool:
+    """Cheap format check that tells signed tokens apart from legacy UUID tokens"""
+    return len(token) == TOKEN_LENGTH and token.startswith(PREFIX)
+
+def sign_token(file_id: str, ttl: Optional[int] = None) -> str:
+    """Encode a file id (and optional expiry) into a URL-safe, HMAC-signed token"""
+    ttl = TOKEN_TTL if ttl is None else ttl
+    expires = int(time.time()) + ttl if ttl > 0 else 0
+    payload = _PAYLOAD.pack(int(file_id), expires)
+    return PREFIX + base64.urlsafe_b64encode(payload + _mac(payload)).decode()
+
+def verify_token(token: str) -> Optional[str]:
+    """Return the file id for a valid, unexpired signed token, otherwise None"""
+    if not signed_tokens_enabled() or not is_signed_token(token):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token[len(PREFIX):])
+    except ValueError:
+        return None
+    payload, mac = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(mac, _mac(payload)):
+        return None
+    file_id, expires = _PAYLOAD.unpack(payload)
+    if expires and expires < time.time():
+        return None
+    return str(file_id)
@@ -0,0 +1,99 @@
+import logging
+import os
+import random
+from typing import List, Optional, Sequence
+import asyncpg
+from dotenv import load_dotenv
+from dbpool import acquire
+from tasks import TaskQueue, background_tasks
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Search statements slower than this are logged and kept in slow_queries
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+# Fraction of slow statements re-run under EXPLAIN (ANALYZE, BUFFERS); 0 disables plan capture
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE', '0.1'))
+# Only the newest rows are kept, so the table rotates instead of growing
+SLOW_QUERY_KEEP = int(os.getenv('SLOW_QUERY_KEEP', '1000'))
+# EXPLAIN ANALYZE re-runs the slow statement, so plan capture gets its own small queue
+# instead of holding the workers that answer callbacks; overflow is stored without a plan
+SLOW_QUERY_EXPLAIN_QUEUE = int(os.getenv('SLOW_QUERY_EXPLAIN_QUEUE', '10'))
+
+explain_tasks = TaskQueue(maxsize=SLOW_QUERY_EXPLAIN_QUEUE, workers=1, max_retries=0)
+
+async def init_slow_query_db():
+    try:
+        async with acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS slow_queries (
+                    id SERIAL PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    tsquery TEXT,
+                    strategy TEXT,
+                    row_count INTEGER,
+                    duration_ms REAL NOT NULL,
+                    plan TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        logger.info("Slow query log initialized successfully")
+    except Exception as e:
+        logger.error(f"Error initializing slow query log: {e}")
+        raise
+
+def record_slow_query(kind: str, sql: str, args: Sequence, duration: float, row_count: int,
+                      tsquery: str = None, strategy: str = None):
+    """Log a search statement if it overran SLOW_QUERY_MS; storing it never delays the caller"""
+    duration_ms = duration * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    logger.warning(f"Slow {kind} query ({duration_ms:.0f}ms, {row_count} rows): {tsquery}")
+    args = list(args)
+    if random.random() < SLOW_QUERY_EXPLAIN_SAMPLE and explain_tasks.submit(
+            'explain slow query', _store_slow_query, kind, sql, args, duration_ms,
+            row_count, tsquery, strategy, True):
+        return
+    background_tasks.submit('record slow query', _store_slow_query, kind, sql, args, duration_ms,
+                            row_count, tsquery, strategy, False)
+
+async def _store_slow_query(kind: str, sql: str, args: list, duration_ms: float, row_count: int,
+                            tsquery: Optional[str], strategy: Optional[str], explain: bool):
+    async with acquire() as conn:
+        plan = None
+        if explain:
+            # ANALYZE runs the statement again; search statements are read-only
+            try:
+                rows = await conn.fetch(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', *args)
+                plan = '\n'.join(row[0] for row in rows)
+            except asyncpg.PostgresError as e:
+                logger.warning(f"Could not capture plan for slow {kind} query: {e}")
+        await conn.execute('''
+            INSERT INTO slow_queries (kind, tsquery, strategy, row_count, duration_ms, plan)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        ''', kind, tsquery, strategy, row_count, duration_ms, plan)
+        await conn.execute('''
+            DELETE FROM slow_queries
+            WHERE id <= (SELECT MAX(id) FROM slow_queries) - $1
+        ''', SLOW_QUERY_KEEP)
+
+async def get_worst_slow_queries(limit: int = 10) -> List[asyncpg.Record]:
+    """Slowest query shapes first, with the newest captured plan for each"""
+    async with acquire() as conn:
+        return await conn.fetch('''
+            SELECT kind, tsquery, COUNT(*) AS occurrences,
+                   MAX(duration_ms) AS max_ms, AVG(duration_ms) AS avg_ms,
+                   MAX(row_count) AS max_rows,
+                   MAX(id) FILTER (WHERE plan IS NOT NULL) AS plan_id
+            FROM slow_queries
+            GROUP BY kind, tsquery
+            ORDER BY max_ms DESC
+            LIMIT $1
+        ''', limit)
+
+async def get_slow_query_plan(id: int) -> Optional[asyncpg.Record]:
+    async with acquire() as conn:
+        return await conn.fetchrow('''
+            SELECT id, kind, tsquery, strategy, row_count, duration_ms, plan, created_at
+            FROM slow_queries WHERE id = $1
+        ''', id)
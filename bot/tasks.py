@@ -0,0 +1,119 @@
+import logging
+import asyncio
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Awaitable, Callable, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+TASK_QUEUE_SIZE = int(os.getenv('TASK_QUEUE_SIZE', '1000'))
+TASK_WORKERS = int(os.getenv('TASK_WORKERS', '4'))
+TASK_MAX_RETRIES = int(os.getenv('TASK_MAX_RETRIES', '3'))
+TASK_RETRY_DELAY = float(os.getenv('TASK_RETRY_DELAY', '0.5'))  # doubled after every failed attempt
+TASK_DRAIN_TIMEOUT = float(os.getenv('TASK_DRAIN_TIMEOUT', '10'))
+
+class TaskQueue:
+    """Bounded queue of fire-and-forget coroutines run by a fixed pool of workers.
+
+    Handlers submit side effects they need not wait for. When the queue is
+    full new work is dropped and counted rather than slowing the handler
+    down; failures are retried with exponential backoff.
+    """
+
+    def __init__(self, maxsize: int = TASK_QUEUE_SIZE, workers: int = TASK_WORKERS,
+                 max_retries: int = TASK_MAX_RETRIES, retry_delay: float = TASK_RETRY_DELAY):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._tasks: List[asyncio.Task] = []
+        self.submitted = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def submit(self, name: str, fn: Callable[..., Awaitable], *args, **kwargs) -> bool:
+        """Queue fn(*args, **kwargs); False if it was dropped"""
+        if not self.running:
+            logger.warning(f"Background task '{name}' dropped: task queue is not running")
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait((name, fn, args, kwargs))
+        except asyncio.QueueFull:
+            logger.warning(f"Background task '{name}' dropped: queue full ({self._queue.maxsize})")
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    async def _execute(self, name: str, fn, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await fn(*args, **kwargs)
+                self.completed += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Background task '{name}' failed after {attempt + 1} attempts: {e}")
+                    self.failed += 1
+                    return
+                self.retried += 1
+                logger.warning(f"Background task '{name}' failed ({e}), retrying")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def _worker(self):
+        while True:
+            name, fn, args, kwargs = await self._queue.get()
+            try:
+                await self._execute(name, fn, args, kwargs)
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = TASK_DRAIN_TIMEOUT):
+        """Finish queued work (up to timeout), then stop the workers"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Abandoning {self._queue.qsize()} background tasks after {timeout}s")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+background_tasks = TaskQueue()
+
+def offload_logging() -> Optional[QueueListener]:
+    """Move the root logger's handlers onto a listener thread so log I/O never blocks the event loop"""
+    root = logging.getLogger()
+    if not root.handlers or any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return None
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
@@ -1,26 +1,52 @@
 import logging
-from telethon import TelegramClient, events, Button
-from telethon.tl.types import Document, DocumentAttributeFilename
+from telethon import events, Button
+from telethon.tl.types import DocumentAttributeFilename
 import uuid
 import re
-import math
+import struct
+import time
 from datetime import datetime 
+from typing import NamedTuple, Optional
 import base64
 from dotenv import load_dotenv
 import os
 import asyncio
+import signal
 import urllib.parse  # Add this import
 from django.conf import settings
 from database import (
-    init_db, store_file_metadata, store_token,
-    get_file_by_id, get_file_by_token, search_files, count_search_results,
-    AsyncPostgresConnection
+    init_db, store_file_metadata, store_files_metadata, store_tokens,
+    get_file_by_id, search_page, SearchCursor,
+    backfill_search_columns, search_cache, search_flights
 )
+from dbpool import init_pool, close_pool
+from broadcast import (
+    init_broadcast_db, create_broadcast_job, get_broadcast_job,
+    start_broadcast, resume_broadcasts
+)
+from hot_files import get_hot_file, get_hot_files, get_file_id_by_token, hot_files, token_files
+from search_query import STRATEGIES
+from memindex import SEARCH_BACKEND, memory_index
+from invalidation import run_invalidation_listener
+from tasks import background_tasks, offload_logging
+from metrics import register_cache_metrics, start_metrics_server, time_handler
+from flood_control import FloodControlClient
+from slow_queries import init_slow_query_db, get_worst_slow_queries, get_slow_query_plan, explain_tasks
+from inline_search import (
+    INLINE_CACHE_TIME, INLINE_MIN_QUERY_LENGTH, inline_debouncer, inline_results, inline_stats,
+    search_within_budget
+)
+from file_refs import REFERENCE_ERRORS, refresh_document, run_reference_refresher
+from signed_tokens import signed_tokens_enabled, sign_token, is_signed_token, verify_token
 from userdb import (
-    init_user_db, add_user, get_all_users, 
-    get_user_count, update_user_activity, get_active_users_count
+    init_user_db, add_user,
+    get_user_count, update_user_activity, get_active_users_count,
+    activity_recorder
+)
+from premium import (
+    init_premium_db, is_premium, add_or_renew_premium, get_premium_status,
+    load_premium_cache, premium_cache_size
 )
-from premium import init_premium_db, is_premium, add_or_renew_premium, get_premium_status
 
 # Load environment variables from .env file
 load_dotenv()
@@ -45,12 +71,10 @@ def init_client(api_id, api_hash, bot_token):
     """Initialize the Telegram client with credentials"""
     global client
     if client is None:
-        client = TelegramClient('bot', api_id, api_hash)
+        client = FloodControlClient('bot', api_id, api_hash)
         client.start(bot_token=bot_token)
     return client
 
-VIDEO_EXTENSIONS = ['.mp4', '.mkv', '.webm', '.ts', '.mov', '.avi', '.flv', '.wmv', '.m4v', '.mpeg', '.mpg', '.3gp', '.3g2']
-
 # List of authorized user IDs
 AUTHORIZED_USER_IDS = [7951420571, 1509468839]  # Replace with your user ID and future moderator IDs
 
@@ -64,49 +88,279 @@ def split_keywords(keyword):
     # Split the normalized keyword into individual words
     return keyword.split()
 
-async def send_file_directly(client, chat_id, file_info):
-    """Helper function to send file directly to user"""
+class UpdateContext(NamedTuple):
+    """Facts about an update resolved once by the router and shared with its handler"""
+    sender_id: int
+    is_admin: bool
+    is_premium: bool
+    received_at: datetime
+    started: float  # time.monotonic() at receipt, for latency logging
+
+async def build_context(event) -> UpdateContext:
+    sender_id = event.sender_id
+    await update_user_activity(sender_id)
+    return UpdateContext(
+        sender_id=sender_id,
+        is_admin=sender_id in AUTHORIZED_USER_IDS,
+        is_premium=await is_premium(sender_id),
+        received_at=datetime.now(),
+        started=time.monotonic()
+    )
+
+def command_name(text) -> Optional[str]:
+    """'/start@SomeBot abc' -> '/start'; None for anything that is not a command"""
+    if not text or not text.startswith('/'):
+        return None
+    return text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+
+def extract_file_metadata(message):
+    """Build the files-table fields for a document message, or None if it has no file name"""
+    document = message.document
+    if document is None:
+        return None
+
+    file_name = None
+    for attr in document.attributes:
+        if isinstance(attr, DocumentAttributeFilename):
+            file_name = attr.file_name
+            break
+    if not file_name:
+        return None
+
+    caption = message.message or ""
+    return {
+        'source_chat_id': message.chat_id,
+        'source_message_id': message.id,
+        # Convert id and access_hash to strings before storing
+        'id': str(document.id),
+        'access_hash': str(document.access_hash),
+        'file_reference': document.file_reference,
+        'mime_type': document.mime_type,
+        'caption': caption,
+        'keywords': normalize_keyword(caption) + " " + normalize_keyword(file_name),
+        'file_name': file_name,
+    }
+
+async def send_file_directly(client, chat_id, hot_file):
+    """Helper function to send file directly to user.
+
+    If Telegram rejects the stored document, it is re-fetched from the
+    file's source message, saved, and the send is retried once.
+    """
+    file_name = hot_file.info['file_name']
     try:
-        id = file_info['id']
-        access_hash = file_info['access_hash']
-        file_reference = file_info['file_reference']
-        mime_type = file_info['mime_type']
-        file_name = file_info['file_name']
-
-        formatted_caption = file_name.replace(" ", ".").replace("@", "")
-
-        document = Document(
-            id=int(id),
-            access_hash=int(access_hash),
-            file_reference=bytes(file_reference),
-            date=None,
-            mime_type=mime_type,
-            size=None,
-            dc_id=None,
-            attributes=[DocumentAttributeFilename(file_name=file_name)]
-        )
-
-        await client.send_file(
-            chat_id,
-            file=document,
-            caption=formatted_caption
-        )
+        try:
+            await client.send_file(chat_id, file=hot_file.document, caption=hot_file.caption)
+        except REFERENCE_ERRORS as e:
+            logger.warning(f"File reference for {file_name} is no longer valid ({e}), refreshing")
+            document = await refresh_document(client, hot_file.info, background=True)
+            if document is None:
+                raise
+            await client.send_file(chat_id, file=document, caption=hot_file.caption)
         logger.info(f"File {file_name} sent successfully.")
         return True
     except Exception as e:
         logger.error(f"Failed to send file {file_name}: {e}")
         return False
 
+def format_display_name(file_name):
+    display_name = file_name.replace('.mp4', '').replace('.', ' ')
+    if len(display_name) > 64:
+        display_name = display_name[:61] + '...'
+    return display_name
+
+def encode_page_cursor(page, cursor):
+    """Pack a page number and keyset cursor into callback-safe text (22 chars)"""
+    packed = struct.pack('>H?Bfq', page, cursor.backward, STRATEGIES.index(cursor.strategy),
+                         cursor.rank, int(cursor.id))
+    return base64.urlsafe_b64encode(packed).decode().rstrip('=')
+
+def decode_page_cursor(data):
+    packed = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    page, backward, strategy, rank, id = struct.unpack('>H?Bfq', packed)
+    return page, SearchCursor(rank, str(id), backward, STRATEGIES[strategy])
+
+SEARCH_HEADER_RE = re.compile(r"Results for '(.*)'$")
+
+def parse_search_header(message_text):
+    """Recover the normalized query from the first line of a results message"""
+    first_line = message_text.split('\n', 1)[0]
+    match = SEARCH_HEADER_RE.search(first_line)
+    return match.group(1) if match else None
+
+async def issue_download_tokens(file_ids):
+    """Map file ids to deep-link tokens: signed when configured, else table-backed"""
+    if signed_tokens_enabled():
+        return {file_id: sign_token(file_id) for file_id in file_ids}
+    # One round trip for the whole page instead of one per button
+    return await store_tokens(file_ids)
+
+async def resolve_download_token(token):
+    """Return the file id for a signed or legacy token, or None if invalid"""
+    if is_signed_token(token):
+        return verify_token(token)
+    return await get_file_id_by_token(token)
+
+def build_download_link(token, file_name):
+    base_url = settings.SITE_URL.rstrip('/')
+    if not base_url.startswith(('http://', 'https://')):
+        base_url = f'https://{base_url}'
+    return f"{base_url}/?token={urllib.parse.quote(token)}&videoName={urllib.parse.quote(file_name)}"
+
+async def build_result_buttons(rows, user_is_premium):
+    buttons = []
+    tokens = {} if user_is_premium else await issue_download_tokens([str(row['id']) for row in rows])
+    for row in rows:
+        id, file_name = row['id'], row['file_name']
+        try:
+            if user_is_premium:
+                # For premium users: Create callback button to send file directly
+                buttons.append([Button.inline(f"📥 {format_display_name(file_name)}", f"send|{id}")])
+            else:
+                # For regular users: Create website link button
+                token = tokens.get(str(id))
+                if token:
+                    website_link = build_download_link(token, file_name)
+                    buttons.append([Button.url(format_display_name(file_name), website_link)])
+        except Exception as e:
+            logger.error(f"Error creating button for file {file_name}: {e}")
+            continue
+    return buttons
+
+def build_pagination_buttons(results, page):
+    if not (results.has_prev or results.has_next) or results.strategy not in STRATEGIES:
+        return []
+    first, last = results.rows[0], results.rows[-1]
+    nav = []
+    if results.has_prev and page > 1:
+        cursor = SearchCursor(first['rank'], first['id'], backward=True, strategy=results.strategy)
+        nav.append(Button.inline("⬅️ Prev", f"page|{encode_page_cursor(page - 1, cursor)}"))
+    nav.append(Button.inline(f"Page {page}", "ignore|"))
+    if results.has_next:
+        cursor = SearchCursor(last['rank'], last['id'], strategy=results.strategy)
+        nav.append(Button.inline("Next ➡️", f"page|{encode_page_cursor(page + 1, cursor)}"))
+    return nav
+
+async def build_inline_results(builder, rows, user_is_premium):
+    """Inline answers: the document itself for premium users, a download link otherwise"""
+    if user_is_premium:
+        # Stored documents become InputDocuments without any upload or network call
+        return await asyncio.gather(*(
+            builder.document(
+                hot_file.document,
+                title=format_display_name(hot_file.info['file_name']),
+                description=hot_file.info['caption'] or None,
+                mime_type=hot_file.info['mime_type'],
+                text=hot_file.caption,
+                id=hot_file.info['id']
+            )
+            for hot_file in await get_hot_files([row['id'] for row in rows])
+        ))
+
+    tokens = await issue_download_tokens([str(row['id']) for row in rows])
+    results = []
+    for row in rows:
+        token = tokens.get(str(row['id']))
+        if not token:
+            continue
+        website_link = build_download_link(token, row['file_name'])
+        results.append(await builder.article(
+            title=format_display_name(row['file_name']),
+            description=row['caption'] or None,
+            text=f"🎬 {row['file_name']}\n\nKlik pautan ini untuk memuat turun fail anda: {website_link}",
+            link_preview=False,
+            buttons=[Button.url("📥 Muat turun", website_link)],
+            id=str(row['id'])
+        ))
+    return results
+
+async def render_search_results(text, results, page, user_is_premium):
+    """Build the header and buttons for one page of search results"""
+    header = f"{results.total_label()} Results for '{text}'"
+    if user_is_premium:
+        header += "\n\n✨ Premium User: Click to download instantly!"
+    buttons = await build_result_buttons(results.rows, user_is_premium)
+    nav = build_pagination_buttons(results, page)
+    if buttons and nav:
+        buttons.append(nav)
+    return header, buttons
+
+_shutdown: Optional[asyncio.Task] = None
+# The event loop only keeps weak references to tasks
+_background_loops = set()
+
+def _log_task_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+def start_background(coro, name: str) -> asyncio.Task:
+    """Run coro alongside the bot, keeping a reference and logging it if it dies"""
+    task = asyncio.create_task(coro, name=name)
+    _background_loops.add(task)
+    task.add_done_callback(_background_loops.discard)
+    task.add_done_callback(_log_task_failure)
+    return task
+
+async def cancel_background(*tasks: asyncio.Task):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def shutdown(client):
+    """Drain queued side effects while the client can still send them, then disconnect"""
+    await background_tasks.stop()
+    await explain_tasks.stop()
+    await client.disconnect()
+
+def install_shutdown_handlers(client):
+    """Turn SIGTERM/SIGINT into shutdown() so main() returns through its cleanup"""
+    def on_signal():
+        global _shutdown
+        if _shutdown is None:
+            _shutdown = asyncio.create_task(shutdown(client))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, on_signal)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers; Ctrl-C still raises KeyboardInterrupt there
+            pass
+
 async def main(api_id=None, api_hash=None, bot_token=None):
     """Main bot function that sets up event handlers and runs the bot"""
     global client
     if client is None:
         client = init_client(api_id, api_hash, bot_token)
     
-    # Initialize database
+    # Initialize the shared connection pool and database
+    await init_pool()
     await init_db()
     await init_user_db()
     await init_premium_db()
+    await load_premium_cache()
+    await init_broadcast_db()
+    await init_slow_query_db()
+    activity_recorder.start()
+    background_tasks.start()
+    explain_tasks.start()
+    log_listener = offload_logging()
+    register_cache_metrics({
+        'search': search_cache,
+        'hot_files': hot_files,
+        'tokens': token_files,
+        'inline': inline_results,
+    })
+    metrics_server = await start_metrics_server()
+
+    if SEARCH_BACKEND == 'memory':
+        await memory_index.load()
+
+    # Cover rows ingested before the search columns existed without delaying startup
+    start_background(backfill_search_columns(), 'backfill_search_columns')
+    # Other processes (ingest command, future workers) tell us which cached entries went stale
+    invalidation_listener = start_background(run_invalidation_listener(), 'invalidation_listener')
+    reference_refresher = start_background(run_reference_refresher(client), 'reference_refresher')
     
     # Start bot if not already started
     if not client.is_connected():
@@ -114,8 +368,10 @@ async def main(api_id=None, api_hash=None, bot_token=None):
         
     logger.info("Main bot created")
 
-    @client.on(events.NewMessage(pattern='/start'))
-    async def start(event):
+    # Pick up broadcasts interrupted by a restart
+    await resume_broadcasts(client, AUTHORIZED_USER_IDS)
+
+    async def start(event, ctx):
         user = event.sender
         await add_user(
             user_id=user.id,
@@ -127,48 +383,17 @@ async def main(api_id=None, api_hash=None, bot_token=None):
         if len(command_args) > 1:
             token = command_args[1]
             try:
-                decoded_token = base64.urlsafe_b64decode(token.encode()).decode()
-                logger.debug(f"Decoded token: {decoded_token}")
-
-                result = await get_file_by_token(token)
+                result = await resolve_download_token(token)
                 logger.debug(f"Token verification result: {result}")
 
                 if result:
                     file_id = result
 
-                    file_info = await get_file_by_id(file_id)
-                    logger.debug(f"File fetch result: {file_info}")
-
-                    if file_info:
-                        # Note: asyncpg returns Record object, access by key
-                        id = file_info['id']
-                        access_hash = file_info['access_hash']
-                        file_reference = file_info['file_reference']
-                        mime_type = file_info['mime_type']
-                        file_name = file_info['file_name']
-
-                        formatted_caption = file_name.replace(" ", ".").replace("@", "")
-
-                        document = Document(
-                            id=int(id),
-                            access_hash=int(access_hash),
-                            file_reference=bytes(file_reference),  # Convert memoryview to bytes
-                            date=None,
-                            mime_type=mime_type,
-                            size=None,
-                            dc_id=None,
-                            attributes=[DocumentAttributeFilename(file_name=file_name)]
-                        )
-
-                        try:
-                            await client.send_file(
-                                event.sender_id,
-                                file=document,
-                                caption=formatted_caption
-                            )
-                            logger.info(f"File {file_name} sent successfully.")
-                        except Exception as e:
-                            logger.error(f"Error sending file: {e}")
+                    hot_file = await get_hot_file(file_id)
+                    logger.debug(f"File fetch result: {hot_file}")
+
+                    if hot_file:
+                        if not await send_file_directly(client, ctx.sender_id, hot_file):
                             await event.respond('Failed to send the file.')
                     else:
                         await event.respond('File not found in the database.')
@@ -183,10 +408,9 @@ async def main(api_id=None, api_hash=None, bot_token=None):
             await event.respond('Hantar movies apa yang anda mahu.')
             logger.warning("No token provided.")
 
-    @client.on(events.NewMessage(pattern='/premium'))
-    async def premium_command(event):
+    async def premium_command(event, ctx):
         """Handle premium status check"""
-        status = await get_premium_status(event.sender_id)
+        status = await get_premium_status(ctx.sender_id)
         if status:
             if status["is_premium"]:
                 message = (
@@ -211,10 +435,9 @@ async def main(api_id=None, api_hash=None, bot_token=None):
                 )
             await event.respond(message)
             
-    @client.on(events.NewMessage(pattern='/addpremium'))
-    async def add_premium_command(event):
+    async def add_premium_command(event, ctx):
         """Handle adding premium users (admin only)"""
-        if event.sender_id not in AUTHORIZED_USER_IDS:
+        if not ctx.is_admin:
             await event.reply("You are not authorized to use this command.")
             return
             
@@ -237,209 +460,159 @@ async def main(api_id=None, api_hash=None, bot_token=None):
             logger.error(f"Error in add_premium_command: {e}")
             await event.reply("An error occurred while processing your request.")
 
-    @client.on(events.NewMessage)
-    async def handle_messages(event):
-        await update_user_activity(event.sender_id)
-        
-        # Check if user is premium for certain operations
-        user_is_premium = await is_premium(event.sender_id)
-        
-        if event.is_private:
-            if event.message.document:
-                try:
-                    user_id = event.message.sender_id
-                    logger.debug(f"User ID: {user_id}")
-
-                    if user_id not in AUTHORIZED_USER_IDS:
-                        await event.reply("Maaf, anda tidak dibenarkan menghantar media kepada bot ini.")
-                        return
-
-                    document = event.message.document
-                    file_name = None
-                    for attr in event.message.document.attributes:
-                        if isinstance(attr, DocumentAttributeFilename):
-                            file_name = attr.file_name
-                            break
-
-                    caption = event.message.message or ""
-                    keywords = normalize_keyword(caption) + " " + normalize_keyword(file_name)
-                    keyword_list = split_keywords(keywords)
-
-                    logger.debug(f"Received document message: {event.message}")
-                    logger.debug(f"Caption: {caption}")
-                    logger.debug(f"Keywords: {keywords}")
-                    logger.debug(f"File Name: {file_name}")
-                    logger.debug(f"Mime Type: {document.mime_type}")
-
-                    # Convert id and access_hash to strings before storing
-                    id = str(document.id)
-                    access_hash = str(document.access_hash)
-                    file_reference = document.file_reference
-                    mime_type = document.mime_type
-
-                    logger.debug(f"Inserting file metadata: id={id}, access_hash={access_hash}, file_reference={file_reference}, mime_type={mime_type}, caption={caption}, keywords={keywords}, file_name={file_name}")
-                    await store_file_metadata(id, access_hash, file_reference, mime_type, caption, keywords, file_name)
-                    logger.info(f"Successfully stored metadata for {file_name}")
-                    await event.reply('File metadata stored.')
-                except Exception as e:
-                    logger.error(f"Failed to store metadata for {file_name}: {e}")
-                    await event.reply('Failed to store file metadata.')
-
-            elif event.message.text and not event.message.text.startswith('/'):
-                try:
-                    await update_user_activity(event.sender_id)
-                    text = normalize_keyword(event.message.text.lower().strip())
-                    keyword_list = split_keywords(text)
-                    logger.debug(f"Received text message: {text}")
-
-                    page = 1  # Default to first page
-                    page_size = 20 if user_is_premium else 10  # Different page sizes for premium users
-                    offset = (page - 1) * page_size
-
-                    db_results = await search_files(keyword_list, page_size, offset)
-                    logger.debug(f"Database search results for keywords '{keyword_list}': {db_results}")
-
-                    total_results = await count_search_results(keyword_list)
-                    total_pages = math.ceil(total_results / page_size)
-
-                    video_results = [result for result in db_results if any(result[2].lower().endswith(ext) for ext in VIDEO_EXTENSIONS)]
-                    logger.debug(f"Filtered video results: {video_results}")
-
-                    if video_results:
-                        logger.info(f"Found {len(video_results)} results for search: {text}")
-                        header = f"{total_results} Results for '{text}'"
-                        buttons = []
-                        
-                        # Check if user is premium
-                        user_is_premium = await is_premium(event.sender_id)
-                        
-                        for id, caption, file_name in video_results:
-                            try:
-                                if user_is_premium:
-                                    # For premium users: Create callback button to send file directly
-                                    display_name = file_name.replace('.mp4', '').replace('.', ' ')
-                                    if len(display_name) > 64:
-                                        display_name = display_name[:61] + '...'
-                                    buttons.append([Button.inline(f"📥 {display_name}", f"send|{id}")])
-                                else:
-                                    # For regular users: Create website link button (existing code)
-                                    token = await store_token(str(id))
-                                    if token:
-                                        safe_video_name = urllib.parse.quote(file_name)
-                                        safe_token = urllib.parse.quote(token)
-                                        base_url = settings.SITE_URL.rstrip('/')
-                                        if not base_url.startswith(('http://', 'https://')):
-                                            base_url = f'https://{base_url}'
-                                        website_link = f"{base_url}/?token={safe_token}&videoName={safe_video_name}"
-                                        
-                                        display_name = file_name.replace('.mp4', '').replace('.', ' ')
-                                        if len(display_name) > 64:
-                                            display_name = display_name[:61] + '...'
-                                        
-                                        buttons.append([Button.url(display_name, website_link)])
-                            except Exception as e:
-                                logger.error(f"Error creating button for file {file_name}: {e}")
-                                continue
-
-                        if buttons:
-                            try:
-                                if user_is_premium:
-                                    await event.respond(header + "\n\n✨ Premium User: Click to download instantly!", buttons=buttons)
-                                else:
-                                    await event.respond(header, buttons=buttons)
-                            except Exception as e:
-                                logger.error(f"Error sending message with buttons: {e}")
-                                await event.reply("Error displaying results. Please try again.")
-                        else:
-                            await event.reply('No valid results to display.')
-                    else:
-                        logger.info(f"No results found for search: {text}")
-                        await event.reply('Movies yang anda cari belum ada boleh request di @Request67_bot.')
-                except Exception as e:
-                    logger.error(f"Error handling text message: {e}")
-                    await event.reply('Failed to process your request.')
+    async def store_document(event, ctx):
+        """Index a single document sent by an admin"""
+        file_name = None
+        try:
+            logger.debug(f"User ID: {ctx.sender_id}")
 
-    @client.on(events.CallbackQuery)
-    async def callback_query_handler(event):
+            if not ctx.is_admin:
+                await event.reply("Maaf, anda tidak dibenarkan menghantar media kepada bot ini.")
+                return
+
+            metadata = extract_file_metadata(event.message)
+            if metadata is None:
+                raise ValueError("document has no file name")
+            file_name = metadata['file_name']
+
+            logger.debug(f"Inserting file metadata: {metadata}")
+            await store_file_metadata(**metadata)
+            logger.info(f"Successfully stored metadata for {file_name}")
+            await event.reply('File metadata stored.')
+        except Exception as e:
+            logger.error(f"Failed to store metadata for {file_name}: {e}")
+            await event.reply('Failed to store file metadata.')
+
+    async def search(event, ctx):
+        """Answer a plain-text message with the first page of matching files"""
+        try:
+            text = normalize_keyword(event.message.text.lower().strip())
+            keyword_list = split_keywords(text)
+            logger.debug(f"Received text message: {text}")
+
+            page_size = 20 if ctx.is_premium else 10  # Different page sizes for premium users
+            results = await search_page(keyword_list, page_size)
+            logger.debug(f"Database search results for keywords '{keyword_list}': {results.rows}")
+
+            if results.rows:
+                logger.info(f"Found {len(results.rows)} results for search: {text} ({results.strategy}) "
+                            f"in {(time.monotonic() - ctx.started) * 1000:.0f}ms")
+                message, buttons = await render_search_results(text, results, 1, ctx.is_premium)
+                if buttons:
+                    try:
+                        await event.respond(message, buttons=buttons)
+                    except Exception as e:
+                        logger.error(f"Error sending message with buttons: {e}")
+                        await event.reply("Error displaying results. Please try again.")
+                else:
+                    await event.reply('No valid results to display.')
+            else:
+                logger.info(f"No results found for search: {text}")
+                await event.reply('Movies yang anda cari belum ada boleh request di @Request67_bot.')
+        except Exception as e:
+            logger.error(f"Error handling text message: {e}")
+            await event.reply('Failed to process your request.')
+
+    async def inline_query_handler(event, ctx):
+        """Search as the user types `@bot title` in any chat"""
+        inline_stats["queries"] += 1
+        try:
+            text = normalize_keyword(event.text or '')
+            if len(text) < INLINE_MIN_QUERY_LENGTH:
+                await event.answer([], cache_time=INLINE_CACHE_TIME, private=True)
+                return
+
+            cache_key = (text, ctx.is_premium)
+            results = inline_results.get(cache_key)
+            if results is not None:
+                inline_stats["cache_hits"] += 1
+            else:
+                # Skip keystrokes that a newer query from the same user already replaced
+                if not await inline_debouncer.settle(ctx.sender_id):
+                    return
+                page = await search_within_budget(split_keywords(text))
+                if page is None:
+                    # Nothing cacheable yet; Telegram asks again on the next keystroke
+                    await event.answer([], cache_time=0, private=True)
+                    return
+                results = await build_inline_results(event.builder, page.rows, ctx.is_premium)
+                inline_results.set(cache_key, results)
+
+            # Premium and regular users get different answers, so only the user's client may cache them
+            await event.answer(results, cache_time=INLINE_CACHE_TIME, private=True)
+            inline_stats["answered"] += 1
+        except Exception as e:
+            logger.error(f"Error answering inline query: {e}")
+
+    async def handle_album(event, ctx):
+        """Store every document of a forwarded album in one batched write"""
+        files = [m for m in (extract_file_metadata(message) for message in event.messages) if m]
+        if not files:
+            return  # Photo albums and the like are not ours to index
+        if not ctx.is_admin:
+            await event.reply("Maaf, anda tidak dibenarkan menghantar media kepada bot ini.")
+            return
+        try:
+            stored = await store_files_metadata(files)
+            logger.info(f"Successfully stored metadata for {stored} album files")
+            await event.reply(f'File metadata stored for {stored} files.')
+        except Exception as e:
+            logger.error(f"Failed to store album metadata: {e}")
+            await event.reply('Failed to store file metadata.')
+
+    async def callback_query_handler(event, ctx):
         try:
             data = event.data.decode('utf-8')
             logger.debug(f"Callback query data: {data}")
 
             if data.startswith("send|"):
                 # Handle direct file sending for premium users
-                user_is_premium = await is_premium(event.sender_id)
-                if not user_is_premium:
+                if not ctx.is_premium:
                     await event.answer("This feature is only available to premium users!", show_alert=True)
                     return
 
                 file_id = data.split("|")[1]
-                file_info = await get_file_by_id(str(file_id))
+                hot_file = await get_hot_file(file_id)
                 
-                if file_info:
-                    await event.answer("Sending file...")
-                    success = await send_file_directly(client, event.sender_id, file_info)
+                if hot_file:
+                    # The spinner can stop while the upload runs; nothing depends on this call
+                    background_tasks.submit('answer callback', event.answer, "Sending file...")
+                    success = await send_file_directly(client, ctx.sender_id, hot_file)
                     if not success:
                         await event.respond("Failed to send file. Please try again.")
                 else:
                     await event.answer("File not found!", show_alert=True)
             
             elif data.startswith("page|"):
-                parts = data.split("|")
-                if len(parts) < 3:
+                try:
+                    page, cursor = decode_page_cursor(data[len("page|"):])
+                except (ValueError, IndexError, struct.error):
                     await event.answer("Invalid page data")
                     return
 
-                _, keyword, page = parts
-                page = int(page)
-                page_size = 10
-                offset = (page - 1) * page_size
+                # The query text lives in the results header, not in the 64-byte callback data
+                message = await event.get_message()
+                keyword = parse_search_header(message.raw_text if message else '')
+                if not keyword:
+                    await event.answer("This search has expired. Please search again.", show_alert=True)
+                    return
 
+                page_size = 20 if ctx.is_premium else 10
                 keyword_list = split_keywords(keyword)
 
-                db_results = await search_files(keyword_list, page_size, offset)
-                logger.debug(f"Database search results for keywords '{keyword_list}': {db_results}")
-
-                total_results = await count_search_results(keyword_list)
-                total_pages = math.ceil(total_results / page_size)
-
-                video_results = [result for result in db_results if any(result[2].lower().endswith(ext) for ext in VIDEO_EXTENSIONS)]
-                logger.debug(f"Filtered video results: {video_results}")
-
-                if video_results:
-                    header = f"{total_results} Results for '{keyword}'"
-                    buttons = [
-                        [Button.inline(file_name or caption or "Unknown File", f"{id}|{page}")]
-                        for id, caption, file_name in video_results
-                    ]
-                    logger.debug(f"Generated buttons: {buttons}")
+                results = await search_page(keyword_list, page_size, cursor)
+                logger.debug(f"Database search results for keywords '{keyword_list}': {results.rows}")
 
-                    # Pagination Buttons
-                    pagination_buttons = []
-                    start_page = max(1, page - 2)
-                    end_page = min(total_pages, start_page + 4)
-
-                    for p in range(start_page, end_page + 1):
-                        if p == page:
-                            pagination_buttons.append(Button.inline(f"[{p}]", f"ignore|{keyword}|{p}"))
-                        else:
-                            pagination_buttons.append(Button.inline(str(p), f"page|{keyword}|{p}"))
-
-                    if page > 1:
-                        pagination_buttons.insert(0, Button.inline("Prev", f"page|{keyword}|{page - 1}"))
-                    if page < total_pages:
-                        pagination_buttons.append(Button.inline("Next", f"page|{keyword}|{page + 1}"))
-
-                    buttons.append(pagination_buttons)
-                    buttons.append([Button.inline("First Page", f"page|{keyword}|1"), Button.inline("Last Page", f"page|{total_pages}")])
-
-                    await event.edit(header, buttons=buttons)
+                if results.rows:
+                    text, buttons = await render_search_results(keyword, results, page, ctx.is_premium)
+                    await event.edit(text, buttons=buttons)
                 else:
-                    await event.edit("No more results.")
+                    await event.answer("No more results.")
             elif data.startswith("ignore|"):
-                pass  # Do nothing if the user clicks on the current page
+                await event.answer()  # Current page indicator, nothing to do
             else:
                 id, current_page = data.split("|")
-                token = await store_token(str(id))
+                token = (await issue_download_tokens([str(id)])).get(str(id))
                 if token:
                     result = await get_file_by_id(str(id))
                     if result:
@@ -459,39 +632,63 @@ async def main(api_id=None, api_hash=None, bot_token=None):
             logger.error(f"Error handling callback query: {e}")
             await event.respond('Failed to process your request.')
 
-    @client.on(events.NewMessage(pattern='/listdb'))
-    async def list_db(event):
+    async def list_db(event, ctx):
         logger.debug("Executing /listdb command")
         c.execute("SELECT * FROM files")
         results = c.fetchall()
         logger.debug(f"Database entries: {results}")
         await event.reply(f"Database entries: {results}")
 
-    @client.on(events.NewMessage(pattern='/stats'))
-    async def stats_command(event):
-        if event.sender_id not in AUTHORIZED_USER_IDS:
+    async def stats_command(event, ctx):
+        if not ctx.is_admin:
             await event.reply("You are not authorized to use this command.")
             return
             
         user_count = await get_user_count()
         active_users = await get_active_users_count()  # Add this function to userdb.py
         
+        cache_stats = search_cache.stats()
+        flight_stats = search_flights.stats()
+        task_stats = background_tasks.stats()
+        file_stats = hot_files.stats()
+        index_line = ""
+        if memory_index.ready:
+            index_stats = memory_index.stats()
+            index_line = (
+                f"🧠 Memory Index: {index_stats['files']} files, {index_stats['tokens']} tokens, "
+                f"{index_stats['memory_mb']:.1f} MB, loaded in {index_stats['load_seconds']:.2f}s, "
+                f"avg query {index_stats['avg_query_us']:.0f}µs\n"
+            )
+        
         stats_message = (
             "📊 Bot Statistics 📊\n\n"
             f"👥 Total Users: {user_count}\n"
             f"📱 Active Users (24h): {active_users}\n"
+            f"💎 Active Premium Users: {premium_cache_size()}\n"
+            f"🔎 Search Cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+            f"({cache_stats['hit_rate']:.1f}%), {cache_stats['size']}/{cache_stats['maxsize']} entries\n"
+            f"🛬 Search Coalescing: {flight_stats['coalesced']} of {flight_stats['calls']} misses shared "
+            f"({flight_stats['coalesce_rate']:.1f}%)\n"
+            f"📦 Hot File Cache: {file_stats['hits']} hits / {file_stats['misses']} misses "
+            f"({file_stats['hit_rate']:.1f}%), {file_stats['size']}/{file_stats['maxsize']} entries\n"
+            f"{index_line}"
+            f"⌨️ Inline: {inline_stats['answered']} answered of {inline_stats['queries']} queries, "
+            f"{inline_stats['cache_hits']} cached, {inline_stats['debounced']} debounced, "
+            f"{inline_stats['over_budget']} over budget\n"
+            f"🧵 Background Tasks: {task_stats['completed']} done, {task_stats['queued']} queued, "
+            f"{task_stats['retried']} retried, {task_stats['failed']} failed, {task_stats['dropped']} dropped\n"
             f"🤖 Bot Status: Online\n"
             f"⏰ Last Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
             "Admin Commands:\n"
             "• /broadcast - Send message to all users\n"
-            "• /stats - Show these statistics"
+            "• /stats - Show these statistics\n"
+            "• /slowqueries - Slowest search queries"
         )
         
         await event.reply(stats_message)
 
-    @client.on(events.NewMessage(pattern='/broadcast'))
-    async def broadcast_command(event):
-        if event.sender_id not in AUTHORIZED_USER_IDS:
+    async def broadcast_command(event, ctx):
+        if not ctx.is_admin:
             await event.reply("You are not authorized to use this command.")
             return
         
@@ -508,67 +705,128 @@ async def main(api_id=None, api_hash=None, bot_token=None):
             await event.reply(usage)
             return
             
-        users = await get_all_users()
-        sent = 0
-        failed = 0
-        skipped = 0
-        
         # Show progress message
         progress = await event.reply("🚀 Broadcasting message...")
         
+        text = event.message.text.replace('/broadcast', '').strip()
+        if reply and reply.media:
+            # If broadcasting a media message
+            caption = None
+            if event.message.text.strip().lower() != '/broadcast none':
+                caption = text or reply.text
+            job_id = await create_broadcast_job(
+                event.chat_id, progress.id,
+                source_chat_id=event.chat_id, source_message_id=reply.id, caption=caption
+            )
+        else:
+            job_id = await create_broadcast_job(event.chat_id, progress.id, text=reply.text if reply else text)
+
+        job = await get_broadcast_job(job_id)
+        start_broadcast(client, job, AUTHORIZED_USER_IDS)
+
+    async def slow_queries_command(event, ctx):
+        """List the slowest logged search queries (admin only)"""
+        if not ctx.is_admin:
+            await event.reply("You are not authorized to use this command.")
+            return
         try:
-            for user in users:
-                # Skip if user is an admin
-                if user['user_id'] in AUTHORIZED_USER_IDS:
-                    skipped += 1
-                    continue
-                    
-                try:
-                    if reply:
-                        # If broadcasting a media message
-                        if reply.media:
-                            caption = None
-                            if event.message.text.strip().lower() != '/broadcast none':
-                                caption = event.message.text.replace('/broadcast', '').strip() or reply.text
-                            
-                            await client.send_file(
-                                user['user_id'],
-                                file=reply.media,
-                                caption=caption
-                            )
-                        else:
-                            await client.send_message(user['user_id'], reply.text)
-                    else:
-                        # If broadcasting text only
-                        message = event.message.text.replace('/broadcast', '').strip()
-                        await client.send_message(user['user_id'], message)
-                    
-                    sent += 1
-                    if sent % 5 == 0:  # Update progress every 5 successful sends
-                        await progress.edit(
-                            f"🚀 Broadcasting...\n"
-                            f"✅ Sent: {sent}\n"
-                            f"❌ Failed: {failed}\n"
-                            f"⏩ Skipped (admins): {skipped}"
-                        )
-                    await asyncio.sleep(0.1)  # Avoid flooding
-                    
-                except Exception as e:
-                    logger.error(f"Failed to send to user {user['user_id']}: {e}")
-                    failed += 1
-                    
-        finally:
-            report = (
-                "📬 Broadcast Completed\n\n"
-                f"✅ Successfully sent: {sent}\n"
-                f"❌ Failed: {failed}\n"
-                f"⏩ Skipped (admins): {skipped}\n"
-                f"👥 Total reach: {sent + failed}\n"
-                f"📊 Success rate: {(sent/(sent+failed)*100 if sent+failed>0 else 0):.1f}%"
+            rows = await get_worst_slow_queries()
+        except Exception as e:
+            logger.error(f"Error loading slow queries: {e}")
+            await event.reply("Failed to load the slow query log.")
+            return
+        if not rows:
+            await event.reply("No slow queries logged.")
+            return
+        lines = ["🐢 Slowest Search Queries\n"]
+        for row in rows:
+            plan = f" — /explain {row['plan_id']}" if row['plan_id'] else ""
+            lines.append(
+                f"• {row['tsquery']} [{row['kind']}]: max {row['max_ms']:.0f}ms, "
+                f"avg {row['avg_ms']:.0f}ms, {row['occurrences']}x, {row['max_rows']} rows{plan}"
             )
-            await progress.edit(report)
+        await event.reply("\n".join(lines))
+
+    async def explain_command(event, ctx):
+        """Show a captured EXPLAIN (ANALYZE, BUFFERS) plan (admin only)"""
+        if not ctx.is_admin:
+            await event.reply("You are not authorized to use this command.")
+            return
+        args = event.message.text.split()
+        if len(args) != 2 or not args[1].isdigit():
+            await event.reply("Usage: /explain <id>")
+            return
+        row = await get_slow_query_plan(int(args[1]))
+        if not row or not row['plan']:
+            await event.reply("No plan captured for that query.")
+            return
+        header = f"{row['tsquery']} [{row['kind']}, {row['strategy']}]: {row['duration_ms']:.0f}ms, {row['row_count']} rows\n\n"
+        # Telegram caps messages at 4096 characters
+        await event.reply(header + row['plan'][:4000 - len(header)])
+
+    commands = {
+        '/start': start,
+        '/premium': premium_command,
+        '/addpremium': add_premium_command,
+        '/listdb': list_db,
+        '/stats': stats_command,
+        '/broadcast': broadcast_command,
+        '/slowqueries': slow_queries_command,
+        '/explain': explain_command,
+    }
+
+    def route_message(event):
+        """Pick the one handler for a message, or None to ignore it"""
+        message = event.message
+        name = command_name(message.text)
+        if name is not None:
+            return commands.get(name)
+        if not event.is_private:
+            return None
+        if message.document:
+            return store_document
+        if message.text:
+            return search
+        return None
+
+    @client.on(events.NewMessage)
+    async def dispatch_message(event):
+        """Single entry point for messages, so each one is processed exactly once"""
+        if event.is_private and event.message.grouped_id:
+            return  # Album parts arrive again, together, through dispatch_album
+        ctx = await build_context(event)
+        handler = route_message(event)
+        if handler is not None:
+            await time_handler(handler.__name__, handler, event, ctx)
 
-    await client.run_until_disconnected()
+    @client.on(events.CallbackQuery)
+    async def dispatch_callback(event):
+        await time_handler('callback_query_handler', callback_query_handler, event, await build_context(event))
+
+    @client.on(events.InlineQuery)
+    async def dispatch_inline_query(event):
+        await time_handler('inline_query_handler', inline_query_handler, event, await build_context(event))
+
+    @client.on(events.Album(func=lambda e: e.is_private))
+    async def dispatch_album(event):
+        await time_handler('handle_album', handle_album, event, await build_context(event))
+
+    # Without this SIGTERM on redeploy kills the process before buffered writes are flushed
+    install_shutdown_handlers(client)
+    try:
+        await client.run_until_disconnected()
+    finally:
+        # Long-running loops go first, while the pool they use is still open
+        await cancel_background(invalidation_listener, reference_refresher)
+        if metrics_server:
+            metrics_server.close()
+        # No-ops when shutdown() already drained them
+        await background_tasks.stop()
+        await explain_tasks.stop()
+        await activity_recorder.stop()
+        if log_listener:
+            log_listener.stop()
+        await close_pool()
 
 if __name__ == "__main__":
     with client:
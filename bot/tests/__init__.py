@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The bot modules import each other as top-level modules
+bot_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if bot_dir not in sys.path:
+    sys.path.insert(0, bot_dir)
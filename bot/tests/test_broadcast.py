@@ -0,0 +1,83 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+from telethon import errors, functions
+from telethon.sessions import StringSession
+import broadcast
+from broadcast import Broadcast, TokenBucket
+from flood_control import FloodControlClient
+from metrics import flood_waits
+
+class FloodingSender:
+    """Stands in for Telethon's MTProtoSender; answers the first request with a FloodWait"""
+
+    def __init__(self, flood_seconds: int):
+        self.flood_seconds = flood_seconds
+        self.flooded_at = None
+
+    def send(self, request, ordered=False):
+        future = asyncio.get_running_loop().create_future()
+        if self.flooded_at is None:
+            self.flooded_at = time.monotonic()
+            future.set_exception(errors.FloodWaitError(request=request, capture=self.flood_seconds))
+        else:
+            future.set_result(None)
+        return future
+
+class FakeBotClient(FloodControlClient):
+    """Routes sends through the real request path onto a FloodingSender"""
+
+    def __init__(self, sender: FloodingSender):
+        super().__init__(StringSession(), 1, 'hash')
+        self.fake_sender = sender
+        self.delivered = []
+
+    async def send_message(self, user_id, text):
+        await self._call(self.fake_sender, functions.help.GetConfigRequest())
+        self.delivered.append((user_id, time.monotonic()))
+
+def make_job(**overrides):
+    job = dict(id=1, admin_chat_id=1, progress_message_id=None, text='hello',
+               source_chat_id=None, source_message_id=None, caption=None,
+               cursor=0, sent=0, failed=0, skipped=0)
+    job.update(overrides)
+    return job
+
+class BroadcastFloodWaitTest(unittest.IsolatedAsyncioTestCase):
+    async def test_short_flood_wait_stalls_every_sender(self):
+        sender = FloodingSender(flood_seconds=1)
+        client = FakeBotClient(sender)
+        user_ids = list(range(1, 31))
+
+        async def iter_user_ids(cursor, batch_size):
+            yield user_ids
+
+        job = Broadcast(client, make_job())
+        job.bucket = TokenBucket(rate=1000, capacity=100)
+        with mock.patch.object(broadcast, 'iter_user_ids', iter_user_ids), \
+                mock.patch.object(Broadcast, '_save', mock.AsyncMock()):
+            await job.run()
+
+        self.assertEqual(job.flood_waits, 1)
+        self.assertEqual(job.sent, len(user_ids))
+        self.assertEqual(sorted(user_id for user_id, _ in client.delivered), user_ids)
+        resumed = sender.flooded_at + sender.flood_seconds
+        # Nothing went out while the wait was running, from any sender
+        stalled = [user_id for user_id, sent_at in client.delivered
+                   if sender.flooded_at < sent_at < resumed - 0.05]
+        self.assertEqual(stalled, [])
+
+    async def test_short_flood_wait_is_slept_off_outside_broadcasts(self):
+        sender = FloodingSender(flood_seconds=1)
+        client = FakeBotClient(sender)
+        counted = flood_waits._values.get(('GetConfigRequest',), 0)
+        started = time.monotonic()
+        await client.send_message(1, 'hello')
+        self.assertGreaterEqual(time.monotonic() - started, 0.95)
+        self.assertEqual(len(client.delivered), 1)
+        # Slept-off waits are still counted
+        self.assertEqual(flood_waits._values[('GetConfigRequest',)], counted + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import asyncio
+import unittest
+from tasks import TaskQueue
+
+class TaskQueueStopTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stop_drains_pending_items(self):
+        queue = TaskQueue(maxsize=100, workers=2)
+        done = []
+
+        async def write(n):
+            await asyncio.sleep(0.01)
+            done.append(n)
+
+        queue.start()
+        for n in range(20):
+            self.assertTrue(queue.submit('write', write, n))
+        await queue.stop(timeout=5)
+
+        self.assertEqual(sorted(done), list(range(20)))
+        self.assertEqual(queue.stats()['completed'], 20)
+        self.assertFalse(queue.running)
+
+    async def test_stop_gives_up_after_timeout(self):
+        queue = TaskQueue(maxsize=100, workers=1)
+        queue.start()
+        queue.submit('hang', asyncio.sleep, 60)
+        await asyncio.wait_for(queue.stop(timeout=0.1), 2)
+        self.assertFalse(queue.running)
+
+if __name__ == '__main__':
+    unittest.main()
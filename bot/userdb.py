@@ -1,155 +1,174 @@
 import logging
-import asyncpg
-from datetime import datetime
-from typing import List, Optional
-from dotenv import load_dotenv
+import asyncio
 import os
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+from dbpool import acquire
+from metrics import instrument_module
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5'))
+
+class ActivityRecorder:
+    """Write-behind buffer for user activity and profile upserts.
+
+    Handlers record into memory; a background task coalesces everything
+    seen since the last flush into two bulk statements. last_active is
+    stamped with the database clock at flush time, so it compares cleanly
+    with NOW() whatever the app server's time zone; the stamp is at most
+    one flush interval late.
+    """
+
+    def __init__(self, interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.interval = interval
+        self._seen: Set[int] = set()
+        self._profiles: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def touch(self, user_id: int):
+        self._seen.add(user_id)
+
+    def record_profile(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        self._profiles[user_id] = (username, first_name, last_name)
+        self.touch(user_id)
+
+    def pending(self) -> int:
+        return len(self._seen)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._seen:
+                return
+            seen, self._seen = self._seen, set()
+            profiles, self._profiles = self._profiles, {}
+            try:
+                async with acquire() as conn:
+                    if profiles:
+                        ids = list(profiles)
+                        await conn.execute('''
+                            INSERT INTO users (user_id, username, first_name, last_name, last_active)
+                            SELECT p.*, CURRENT_TIMESTAMP
+                            FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[]) AS p
+                            ON CONFLICT (user_id)
+                            DO UPDATE SET
+                                username = EXCLUDED.username,
+                                first_name = EXCLUDED.first_name,
+                                last_name = EXCLUDED.last_name,
+                                last_active = EXCLUDED.last_active
+                        ''', ids, [profiles[i][0] for i in ids], [profiles[i][1] for i in ids],
+                            [profiles[i][2] for i in ids])
+
+                    active = [i for i in seen if i not in profiles]
+                    if active:
+                        await conn.execute('''
+                            UPDATE users
+                            SET last_active = CURRENT_TIMESTAMP
+                            WHERE user_id = ANY($1::bigint[])
+                        ''', active)
+                logger.debug(f"Flushed activity for {len(seen)} users")
+            except Exception as e:
+                logger.error(f"Error flushing user activity: {e}")
+                # Keep the batch for the next flush without clobbering newer profiles
+                self._seen |= seen
+                for user_id, profile in profiles.items():
+                    self._profiles.setdefault(user_id, profile)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and write out anything still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+activity_recorder = ActivityRecorder()
+
 async def init_user_db():
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        # Create users table
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        async with acquire() as conn:
+            # Create users table
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
         logger.info("User database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing user database: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 async def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> bool:
-    conn = None
-    try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        await conn.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET 
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                last_active = CURRENT_TIMESTAMP
-        ''', user_id, username, first_name, last_name)
-        return True
-    except Exception as e:
-        logger.error(f"Error adding user: {e}")
-        return False
-    finally:
-        if conn:
-            await conn.close()
-
-async def get_all_users() -> List[dict]:
-    conn = None
-    try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        users = await conn.fetch('SELECT * FROM users ORDER BY joined_date DESC')
-        return [dict(user) for user in users]
-    except Exception as e:
-        logger.error(f"Error getting users: {e}")
-        return []
-    finally:
-        if conn:
-            await conn.close()
+    """Queue a user upsert; it is written by the next activity flush"""
+    activity_recorder.record_profile(user_id, username, first_name, last_name)
+    return True
+
+async def iter_user_ids(after: int = 0, batch_size: int = 1000) -> AsyncIterator[List[int]]:
+    """Stream user ids in ascending order, one keyset batch at a time.
+
+    Only one batch is held in memory and no connection is pinned between
+    batches, so callers may do slow work (like sending messages) per batch.
+    """
+    while True:
+        async with acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT user_id FROM users
+                WHERE user_id > $1
+                ORDER BY user_id
+                LIMIT $2
+            ''', after, batch_size)
+        if not rows:
+            return
+        batch = [row['user_id'] for row in rows]
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1]
 
 async def get_user_count() -> int:
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        return await conn.fetchval('SELECT COUNT(*) FROM users')
+        async with acquire() as conn:
+            return await conn.fetchval('SELECT COUNT(*) FROM users')
     except Exception as e:
         logger.error(f"Error getting user count: {e}")
         return 0
-    finally:
-        if conn:
-            await conn.close()
 
 async def update_user_activity(user_id: int):
-    conn = None
-    try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
-        await conn.execute('''
-            UPDATE users 
-            SET last_active = CURRENT_TIMESTAMP 
-            WHERE user_id = $1
-        ''', user_id)
-    except Exception as e:
-        logger.error(f"Error updating user activity: {e}")
-    finally:
-        if conn:
-            await conn.close()
+    """Queue a last_active bump; it is written by the next activity flush"""
+    activity_recorder.touch(user_id)
 
 async def get_active_users_count() -> int:
-    conn = None
     try:
-        conn = await asyncpg.connect(
-            database=os.getenv('PGDATABASE'),
-            user=os.getenv('PGUSER'),
-            password=os.getenv('PGPASSWORD'),
-            host=os.getenv('PGHOST'),
-            port=os.getenv('PGPORT')
-        )
-        
         # Count users active in the last 24 hours
         query = '''
             SELECT COUNT(*) 
             FROM users 
             WHERE last_active >= NOW() - INTERVAL '24 hours'
         '''
-        return await conn.fetchval(query)
+        async with acquire() as conn:
+            return await conn.fetchval(query)
     except Exception as e:
         logger.error(f"Error getting active users count: {e}")
         return 0
-    finally:
-        if conn:
-            await conn.close()
+
+instrument_module(globals())
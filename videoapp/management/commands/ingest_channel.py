@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand, CommandError
+import asyncio
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add bot directory to Python path
+bot_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../bot'))
+if bot_dir not in sys.path:
+    sys.path.insert(0, bot_dir)
+
+from telethon import TelegramClient, errors, utils
+from dbpool import init_pool, close_pool
+from database import init_db, store_files_metadata, get_ingest_progress
+from file_refs import GET_MESSAGES_CHUNK
+from telegram_bot import extract_file_metadata
+
+class Command(BaseCommand):
+    help = (
+        'Imports every document from a channel or chat history into the files index. '
+        'Reading history needs a user account session; the first run asks to log in. '
+        'Documents are then re-fetched by the bot, which must be a member of the chat, '
+        'because access hashes and file references only work for the account that fetched them. '
+        'Re-running resumes after the last imported message.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat', help='Channel username, invite link or numeric id')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Documents loaded per COPY + merge')
+        parser.add_argument('--session', default='ingest',
+                            help='Telethon session name for the user account')
+        parser.add_argument('--bot-session', default='ingest_bot',
+                            help='Telethon session name for the bot; keep it apart from the running bot')
+        parser.add_argument('--from-start', action='store_true',
+                            help='Ignore saved progress and walk the whole history')
+
+    def handle(self, *args, **options):
+        api_id = os.getenv('API_ID')
+        api_hash = os.getenv('API_HASH')
+        bot_token = os.getenv('BOT_TOKEN')
+        if not api_id or not api_hash or not bot_token:
+            raise CommandError('API_ID, API_HASH and BOT_TOKEN must be set')
+
+        stored = asyncio.run(self.ingest(int(api_id), api_hash, bot_token, options))
+        self.stdout.write(f'Ingest complete: {stored} documents stored')
+
+    async def resolve_as_bot(self, bot, bot_chat, message_ids):
+        """Fetch the messages again through the bot so the stored document is one it can send"""
+        messages = await bot.get_messages(bot_chat, ids=message_ids)
+        files = []
+        for message_id, message in zip(message_ids, messages):
+            metadata = extract_file_metadata(message) if message else None
+            if metadata:
+                files.append(metadata)
+            else:
+                self.stderr.write(f'Message {message_id} is not visible to the bot; skipped')
+        return files
+
+    async def ingest(self, api_id, api_hash, bot_token, options):
+        await init_pool()
+        client = TelegramClient(options['session'], api_id, api_hash)
+        bot = TelegramClient(options['bot_session'], api_id, api_hash)
+        try:
+            await init_db()
+            await client.start()
+            await bot.start(bot_token=bot_token)
+
+            entity = await client.get_entity(options['chat'])
+            source = str(utils.get_peer_id(entity))
+            try:
+                bot_chat = await bot.get_input_entity(int(source))
+            except (ValueError, errors.RPCError) as e:
+                raise CommandError(f'The bot cannot see {options["chat"]}; add it to the chat first ({e})')
+
+            last_id = 0 if options['from_start'] else await get_ingest_progress(source)
+            self.stdout.write(f'Ingesting {source} after message {last_id}...')
+
+            pending_ids = []
+            batch = []
+            stored = 0
+            # Every message up to here is either stored or queued in batch
+            resolved_id = last_id
+            async for message in client.iter_messages(entity, reverse=True, min_id=last_id):
+                last_id = message.id
+                if message.document:
+                    pending_ids.append(message.id)
+                if len(pending_ids) >= GET_MESSAGES_CHUNK:
+                    batch += await self.resolve_as_bot(bot, bot_chat, pending_ids)
+                    pending_ids = []
+                    resolved_id = last_id
+                if len(batch) >= options['batch_size']:
+                    stored += await store_files_metadata(batch, progress=(source, resolved_id))
+                    batch = []
+                    self.stdout.write(f'{stored} documents stored (message {resolved_id})')
+
+            if pending_ids:
+                batch += await self.resolve_as_bot(bot, bot_chat, pending_ids)
+            # Saves progress even when the tail of the history had no documents
+            stored += await store_files_metadata(batch, progress=(source, last_id))
+            return stored
+        finally:
+            await client.disconnect()
+            await bot.disconnect()
+            await close_pool()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+import asyncio
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add bot directory to Python path
+bot_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../bot'))
+if bot_dir not in sys.path:
+    sys.path.insert(0, bot_dir)
+
+from dbpool import init_pool, close_pool
+from database import init_db, backfill_search_columns
+
+class Command(BaseCommand):
+    help = 'Creates the search columns and backfills them for existing files in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows updated per transaction')
+
+    def handle(self, *args, **options):
+        total = asyncio.run(self.migrate(options['batch_size']))
+        self.stdout.write(f'Search backfill complete: {total} files updated')
+
+    async def migrate(self, batch_size):
+        await init_pool()
+        try:
+            await init_db()
+            return await backfill_search_columns(batch_size)
+        finally:
+            await close_pool()
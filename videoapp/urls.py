@@ -4,4 +4,5 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('countdown/', views.countdown, name='countdown'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,4 +1,13 @@
+import os
+import urllib.error
+import urllib.request
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import render
+from bot.signed_tokens import is_signed_token, verify_token
+from bot.metrics import METRICS_HOST, METRICS_PORT
+
+# Scrapers must send "Authorization: Bearer <token>"; unset keeps /metrics/ switched off
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 def index(request):
     # Pass any URL parameters to the template
@@ -7,8 +16,24 @@ def index(request):
 def countdown(request):
     token = request.GET.get('token', '')
     video_name = request.GET.get('videoName', '')
+    # Signed tokens are checked locally; legacy tokens are resolved by the bot
+    if is_signed_token(token) and verify_token(token) is None:
+        return HttpResponseBadRequest('Pautan tidak sah atau telah tamat tempoh.')
     context = {
         'token': token,
         'video_name': video_name
     }
     return render(request, 'countdown.html', context)
+
+def metrics(request):
+    # The registry lives in the bot process; relay its local listener
+    if not METRICS_TOKEN:
+        raise Http404()
+    if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return HttpResponseForbidden()
+    try:
+        with urllib.request.urlopen(f'http://{METRICS_HOST}:{METRICS_PORT}/metrics', timeout=5) as response:
+            body = response.read()
+    except (urllib.error.URLError, OSError):
+        return HttpResponse('Bot metrics unavailable\n', status=503, content_type='text/plain')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')